@@ -3,9 +3,12 @@ import os
 import sys # noqa: F401
 import math
 import json
+import hashlib
+import functools
 import logging
 import argparse
 from enum import Enum, auto
+from typing import Any
 
 import numpy as np
 
@@ -15,7 +18,8 @@ from modules.utils import (
 )
 from modules.types import Fraction, Timespan
 from modules.types.__compatibilities__.enum import StrEnum
-from modules.video_scanner.state import VideoState
+from modules.video_scanner.state import VideoState, MarkerGate
+from modules.video_scanner import cache as scan_cache
 from modules import debug_flags
 
 log = logging.getLogger(__name__)
@@ -70,11 +74,44 @@ SEGMENT_DEBUG_MODIFIER = DebugMode.FORCE_DISABLE
 # Splits Debug Modifier should left automatically check.
 SPLITS_DEBUG_MODIFIER = DebugMode.AUTO
 
-def obtain_event_data(file):
+# Markers searched only while they can still change scan states.
+MARKER_SCHEDULE = {
+  # results only follow a gameplay
+  'battle-result-victory': MarkerGate(after = (VideoState.GAMEPLAY_DETECT,)),
+  'battle-result-defeat': MarkerGate(after = (VideoState.GAMEPLAY_DETECT,)),
+  # formation is not shown past the loading screen until the attempt concludes
+  'formation-icons': MarkerGate(
+    until = (VideoState.LOADING_SCREEN,),
+    rearm = (VideoState.GAMEPLAY_CONCLUDE_SUCCESS, VideoState.GAMEPLAY_CONCLUDE_FAILURE),
+  ),
+}
+
+# Options passed through video scanning task.
+SCAN_OPTIONS : dict[str, Any] = {
+  'jobs': 1,
+  'cache': True,
+  'probe_interval': 0,
+  'prefetch': 0,
+  'decoder': 'opencv',
+  'decoder_threads': 0,
+  'luma': False,
+  'detection_height': 0,
+  'scale_markers': False,
+  'match_engine': 'split',
+  'pyramid_match': False,
+  'learn_regions': False,
+  'region_widen_span': 30,
+  'marker_schedule': MARKER_SCHEDULE,
+  'sampling_cadence': False,
+  'marker_threads': 0,
+  'batch_frames': 0,
+  'batch_threads': False,
+  'pipeline_workers': 0,
+}
+
+def precalculated_states_mode() -> bool:
   '''
-  Create state data or loads it.
-
-  Branching only used for debugging.
+  Determines whether to load pre-calculated states instead of scanning.
   '''
   default_mode = not os.path.exists(DebugFiles.STATES)
   if SEGMENT_DEBUG_MODIFIER is not DebugMode.AUTO:
@@ -83,8 +120,16 @@ def obtain_event_data(file):
     else:
       default_mode = SEGMENT_DEBUG_MODIFIER == DebugMode.FORCE_DISABLE
 
-  if default_mode:
-    return task.scan_video_timing(file)
+  return not default_mode
+
+def obtain_event_data(file):
+  '''
+  Create state data or loads it.
+
+  Branching only used for debugging.
+  '''
+  if not precalculated_states_mode():
+    return task.scan_video_timing(file, **SCAN_OPTIONS)
   else:
     import importlib
     global_plus = {}
@@ -102,6 +147,17 @@ def obtain_event_data(file):
     assert global_plus['output'] is not None
     return global_plus['output']
 
+def obtain_batch_event_data(files):
+  '''
+  Create state data of every files concurrently, or loads it.
+
+  Returns state data and scanning errors of each file.
+  '''
+  if len(files) <= 1 or precalculated_states_mode():
+    return {fn: obtain_event_data(fn) for fn in files}, {}
+
+  return task.scan_video_timing_batch(list(files), **SCAN_OPTIONS)
+
 def convert_state_to_matrix(state_events):
   time = np.array([state_event.time for state_event in state_events])
   state_count = len(VideoState)
@@ -116,8 +172,10 @@ def convert_state_to_matrix(state_events):
 
   return time, states
 
-def scan_video_points(file):
-  event_times, event_changes = convert_state_to_matrix(obtain_event_data(file))
+def scan_video_points(file, state_events = None):
+  if state_events is None:
+    state_events = obtain_event_data(file)
+  event_times, event_changes = convert_state_to_matrix(state_events)
 
   # Store EOF frame count and remove EOF state flag
   end_point = next((y for y, x in zip(*np.where(event_changes == 1)) if x == VideoState.EOF.value - 1), None)
@@ -246,6 +304,38 @@ def scan_video_points(file):
 
   return split_keys
 
+@functools.cache
+def splits_source_hash() -> str:
+  '''
+  Hash of split conversion logic, invalidates cached splits on change.
+  '''
+  with open(__file__, 'rb') as f:
+    return hashlib.blake2b(f.read(), digest_size=20).hexdigest()
+
+def splits_cache_salt(jobs : int = 1) -> str:
+  '''
+  Salt of cached splits, shares scan options with cached states.
+  '''
+  scan_options = {k: v for k, v in SCAN_OPTIONS.items() if k not in ('jobs', 'cache')}
+  return splits_source_hash() + task.cache_salt(task.effective_scan_options(scan_options, jobs = jobs))
+
+def load_cached_splits(file, *, salt : str):
+  payload = scan_cache.load(file, 'splits', salt = salt)
+  if payload is None:
+    return None
+
+  return {
+    VideoSegment[segment]: Timespan(Fraction(*start), Fraction(*end))
+    for segment, (start, end) in payload.items()
+  }
+
+def store_cached_splits(file, timing, *, salt : str):
+  payload = {
+    segment.name: [list(span.start), list(span.end)]
+    for segment, span in timing.items()
+  }
+  scan_cache.store(file, 'splits', payload, salt = salt)
+
 def convert_video_splits(*files):
   '''
   Processes further existing split data of each files.
@@ -254,11 +344,26 @@ def convert_video_splits(*files):
   if debug_mode and SPLITS_DEBUG_MODIFIER is DebugMode.FORCE_DISABLE:
     debug_mode = False
 
+  errors = {}
   if not debug_mode:
-    result = dict(
-      (fn, scan_video_points(fn))
-      for fn in files
-    )
+    use_cache = SCAN_OPTIONS['cache'] and not precalculated_states_mode()
+    result = {}
+    if use_cache:
+      # taken before scanning, as cached states are
+      salt = splits_cache_salt(SCAN_OPTIONS['jobs'] if len(files) <= 1 else 1)
+      result.update(
+        (fn, timing)
+        for fn, timing in ((fn, load_cached_splits(fn, salt = salt)) for fn in files)
+        if timing is not None
+      )
+
+    event_data, errors = obtain_batch_event_data([fn for fn in files if fn not in result])
+    for fn, state_events in event_data.items():
+      result[fn] = scan_video_points(fn, state_events)
+      if use_cache:
+        store_cached_splits(fn, result[fn], salt = salt)
+
+    result = {fn: result[fn] for fn in files if fn in result}
   else:
     exec_globals = {k: v for k, v in globals().items()}
     exec(
@@ -293,6 +398,7 @@ def convert_video_splits(*files):
 
   return {
     'results': result,
+    'errors': errors,
   }
 
 def set_debug_segment_flag(parsed):
@@ -307,11 +413,53 @@ def set_debug_segment_flag(parsed):
       log.info('Program will always scan the given video files.')
       SEGMENT_DEBUG_MODIFIER = DebugMode.FORCE_DISABLE
 
+def set_scan_options(parsed):
+  if 'scan_jobs' in parsed:
+    SCAN_OPTIONS['jobs'] = max(1, parsed.scan_jobs)
+  if 'scan_cache' in parsed:
+    SCAN_OPTIONS['cache'] = parsed.scan_cache
+  if 'scan_probe_interval' in parsed:
+    SCAN_OPTIONS['probe_interval'] = max(0, parsed.scan_probe_interval)
+  if 'scan_prefetch' in parsed:
+    SCAN_OPTIONS['prefetch'] = max(0, parsed.scan_prefetch)
+  if 'scan_decoder' in parsed:
+    SCAN_OPTIONS['decoder'] = parsed.scan_decoder
+  if 'scan_decoder_threads' in parsed:
+    SCAN_OPTIONS['decoder_threads'] = max(0, parsed.scan_decoder_threads)
+  if 'scan_luma' in parsed:
+    SCAN_OPTIONS['luma'] = parsed.scan_luma
+  if 'scan_detection_height' in parsed:
+    SCAN_OPTIONS['detection_height'] = max(0, parsed.scan_detection_height)
+  if 'scan_scale_markers' in parsed:
+    SCAN_OPTIONS['scale_markers'] = parsed.scan_scale_markers
+  if 'scan_match_engine' in parsed:
+    SCAN_OPTIONS['match_engine'] = parsed.scan_match_engine
+  if 'scan_pyramid_match' in parsed:
+    SCAN_OPTIONS['pyramid_match'] = parsed.scan_pyramid_match
+  if 'scan_learn_regions' in parsed:
+    SCAN_OPTIONS['learn_regions'] = parsed.scan_learn_regions
+  if 'scan_region_widen_span' in parsed:
+    SCAN_OPTIONS['region_widen_span'] = max(0, parsed.scan_region_widen_span)
+  if 'scan_sampling_cadence' in parsed:
+    SCAN_OPTIONS['sampling_cadence'] = parsed.scan_sampling_cadence
+  if 'scan_marker_threads' in parsed:
+    SCAN_OPTIONS['marker_threads'] = max(0, parsed.scan_marker_threads)
+  if 'scan_batch_frames' in parsed:
+    SCAN_OPTIONS['batch_frames'] = max(0, parsed.scan_batch_frames)
+  if 'scan_batch_threads' in parsed:
+    SCAN_OPTIONS['batch_threads'] = parsed.scan_batch_threads
+  if 'scan_pipeline_workers' in parsed:
+    SCAN_OPTIONS['pipeline_workers'] = max(0, parsed.scan_pipeline_workers)
+  if SCAN_OPTIONS['jobs'] <= 1:
+    # marker threads only apply to scans of a single process
+    task.split_opencv_threads(SCAN_OPTIONS['marker_threads'])
+
 def execute_cutoff_detect(parsed):
   '''
   Scan and determine raw timespan of an event for a given file.
   '''
   set_debug_segment_flag(parsed)
+  set_scan_options(parsed)
 
   files = unify_list(parsed.files)
   splits = convert_video_splits(*files)
@@ -329,9 +477,12 @@ def execute_raid_merge(parsed):
   '''
   Splices Total Assault videos.
   '''
+  set_scan_options(parsed)
   video_files = parsed.files
   image_files = parsed.team_overlays or []
   video_splits = convert_video_splits(*video_files)
+  assert not video_splits['errors'], \
+    'failed to scan {}'.format(', '.join(video_splits['errors']))
 
   for files, key in zip([image_files, video_files], ('image', 'video')):
     deduped = unify_list(files)
@@ -354,9 +505,12 @@ def execute_jfd_merge(parsed):
   '''
   Splices Joint Firing Drill videos.
   '''
+  set_scan_options(parsed)
   video_files = parsed.files
   image_files = parsed.team_overlays or [None]
   video_splits = convert_video_splits(*video_files)
+  assert not video_splits['errors'], \
+    'failed to scan {}'.format(', '.join(video_splits['errors']))
 
   for files, key in zip([video_files], ('video')):
     deduped = unify_list(files)
@@ -30,6 +30,116 @@ def option_mixin_group_render():
 
   return parser
 
+def option_mixin_scan_options():
+  '''
+  Parser option mixin to configure video scanning flow.
+  '''
+  parser = argparse.ArgumentParser(add_help=False)
+  parser.add_argument(
+    '-j', '--jobs',
+    action='store', metavar='count',
+    dest='scan_jobs', default=1, type=int,
+    help='Number of processes to scan a video file with.',
+  )
+  parser.add_argument(
+    '--probe-interval',
+    action='store', metavar='frames',
+    dest='scan_probe_interval', default=0, type=int,
+    help='Probes every N-th frame first, then scans frame-by-frame only around state changes, keep it below the shortest state.',
+  )
+  parser.add_argument(
+    '--prefetch',
+    action='store', metavar='frames',
+    dest='scan_prefetch', default=0, type=int,
+    help='Decodes up to N frames ahead on a background thread.',
+  )
+  parser.add_argument(
+    '--decoder',
+    action='store', choices=('opencv', 'ffmpeg', 'auto'),
+    dest='scan_decoder', default='opencv',
+    help='Video decoding backend for scanning.',
+  )
+  parser.add_argument(
+    '--decoder-threads',
+    action='store', metavar='count',
+    dest='scan_decoder_threads', default=0, type=int,
+    help='Thread count of FFMPEG decoder, 0 for automatic.',
+  )
+  parser.add_argument(
+    '--luma',
+    action='store_true', dest='scan_luma',
+    help='Decodes luma plane only, converting to color only for color markers. Requires FFMPEG decoder.',
+  )
+  parser.add_argument(
+    '--scale-markers',
+    action='store_true', dest='scan_scale_markers',
+    help='Scales detection markers to the video resolution.',
+  )
+  parser.add_argument(
+    '--detection-height',
+    action='store', metavar='pixels',
+    dest='scan_detection_height', default=0, type=int,
+    help='Resizes frames to given height before detection, implies --scale-markers.',
+  )
+  parser.add_argument(
+    '--match-engine',
+    action='store', choices=('split', 'fused', 'fft'),
+    dest='scan_match_engine', default='split',
+    help='Marker matching engine, fused scores masked markers finitely, fft transforms each frame region once for every marker.',
+  )
+  parser.add_argument(
+    '--pyramid-match',
+    action='store_true', dest='scan_pyramid_match',
+    help='Matches large markers on a downscaled frame first, may miss hits scoring low when downscaled.',
+  )
+  parser.add_argument(
+    '--learn-regions',
+    action='store_true', dest='scan_learn_regions',
+    help='Searches markers only around where they were found in earlier scans of the same resolution.',
+  )
+  parser.add_argument(
+    '--region-widen-span',
+    action='store', metavar='seconds',
+    dest='scan_region_widen_span', default=30, type=float,
+    help='Searches full frame once every given span a marker is not found in its learned region. '
+      'A marker shown outside its learned region in between is missed, shorter spans miss less.',
+  )
+  parser.add_argument(
+    '--sampling-cadence',
+    action='store_true', dest='scan_sampling_cadence',
+    help='Samples slow detectors sparsely, every frame only around transitions.',
+  )
+  parser.add_argument(
+    '--marker-threads',
+    action='store', metavar='N',
+    dest='scan_marker_threads', default=0, type=int,
+    help='Matches markers of a frame on N threads, for scans without --jobs.',
+  )
+  parser.add_argument(
+    '--batch-frames',
+    action='store', metavar='N',
+    dest='scan_batch_frames', default=0, type=int,
+    help='Reads N frames ahead and matches small fixed-region markers on all of them at once.',
+  )
+  parser.add_argument(
+    '--batch-threads',
+    action='store_true', dest='scan_batch_threads',
+    help='Scans multiple files on threads of one process instead of one process each.',
+  )
+  parser.add_argument(
+    '--pipeline-workers',
+    action='store', metavar='N',
+    dest='scan_pipeline_workers', default=0, type=int,
+    help='Decodes on one process and detects markers on N processes sharing frames through memory.',
+  )
+  parser.add_argument(
+    '--no-scan-cache',
+    action='store_false', dest='scan_cache',
+    help="Don't use or store cached scan results.",
+  )
+
+  return parser
+
 def option_mixin_set_of_files():
   '''
   Parser option mixin to receive set of input files.
@@ -108,11 +218,12 @@ def define_parser(g):
   )
 
   group_render_mixin = option_mixin_group_render()
+  scan_options_mixin = option_mixin_scan_options()
   set_files_mixin = option_mixin_set_of_files()
 
-  option_action_cutoff_detect(group_parser, set_files_mixin)
-  option_action_raid_merge(group_parser, group_render_mixin, set_files_mixin)
-  option_action_jfd_merge(group_parser, group_render_mixin, set_files_mixin)
+  option_action_cutoff_detect(group_parser, scan_options_mixin, set_files_mixin)
+  option_action_raid_merge(group_parser, group_render_mixin, scan_options_mixin, set_files_mixin)
+  option_action_jfd_merge(group_parser, group_render_mixin, scan_options_mixin, set_files_mixin)
 
   delete = set(['define_parser'])
   delete.update(
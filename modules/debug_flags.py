@@ -15,6 +15,9 @@ SHOW_STATE_CHANGES = True
 # logs marker detection every scanned frames.
 SHOW_MARKER_DETECTION = False
 
+# logs reject rate of every marker cascade stage after scanning.
+SHOW_CASCADE_STATS = True
+
 # prints state changes summary in a simplified form.
 # prints finalized states for video splices.
 SHOW_SCANNED_SPLITS = True
@@ -1,19 +1,170 @@
-from typing import Any # noqa: F401
+import os
+import logging
+from typing import Any
 
-import cv2 as cv # noqa: F401
+import cv2 as cv
 
 import modules.video_ops as ops
 from modules.video_scanner import task as scanner_task
+from modules.video_scanner import chunk as scanner_chunk
+from modules.video_scanner import batch as scanner_batch
+from modules.video_scanner import cache as scanner_cache
+from modules.video_scanner import coarse as scanner_coarse
+from modules.video_scanner import pipeline as scanner_pipeline
+from modules.video_scanner import roi as scanner_roi
+
+log = logging.getLogger(__name__)
+
+# Scan options that never change the scan result.
+CACHE_NEUTRAL_OPTIONS = frozenset([
+  'prefetch',
+  'decoder_threads',
+  'marker_threads',
+  'batch_threads',
+])
+
+def split_opencv_threads(threads : int):
+  '''
+  Splits the cores between given threads and OpenCV threads of each.
+
+  OpenCV thread count is process wide, so it is set once
+  before scanning instead of by each scan.
+  '''
+  if threads > 1:
+    cv.setNumThreads(max(1, (os.cpu_count() or 1) // threads))
+
+def effective_scan_options(scan_options : dict[str, Any], *, jobs : int = 1) -> dict[str, Any]:
+  '''
+  Drops scan options not applied by the chosen scanning mode.
+  '''
+  pipeline = scan_options.get('pipeline_workers', 0) > 0 and jobs <= 1 and scan_options.get('probe_interval', 0) <= 1
+  if pipeline and scan_options.get('learn_regions', False):
+    # detector processes search configured regions only
+    scan_options = {**scan_options, 'learn_regions': False}
+  return scan_options
+
+def cache_salt(scan_options : dict[str, Any]) -> str:
+  salt = repr(sorted((k, v) for k, v in scan_options.items() if k not in CACHE_NEUTRAL_OPTIONS))
+  if scan_options.get('learn_regions', False):
+    # search regions come from earlier scans
+    salt += scanner_roi.fingerprint_profiles()
+  return salt
+
+def scan_video_timing(video_file : str, *, jobs : int = 1, cache : bool = True, **scan_options):
+  '''
+  Scans state changes of a video file.
+
+  Scan options are keyword arguments passed through the scanner:
+  - probe_interval, scans around changes between every N-th frame only.
+  - prefetch, decodes up to N frames ahead on a background thread.
+  - decoder, decoding backend (opencv, ffmpeg, auto).
+  - decoder_threads, thread count of FFmpeg decoder.
+  - luma, decodes luma plane only, color is converted when a color marker needs it.
+  - detection_height, resizes frames to given height before detection, scaling markers along.
+  - scale_markers, scales markers to the frame height.
+  - match_engine, marker matching engine (split, fused, fft).
+  - pyramid_match, matches large markers coarse-to-fine, may miss hits scoring low when downscaled.
+  - learn_regions, searches markers around where they were found in earlier scans.
+  - region_widen_span, seconds without a hit before the full frame is searched once instead of learned regions.
+  - marker_schedule, markers gated by scan states, see `state.MarkerGate`.
+  - sampling_cadence, samples slow detectors and markers sparsely away from transitions.
+  - marker_threads, matches markers of a frame on N threads, single process scans only.
+    OpenCV threads are left to the caller, see `split_opencv_threads`.
+  - batch_frames, matches fixed-region markers on N frames read ahead with one call.
+  - pipeline_workers, decodes on one process and detects markers on N processes through shared memory.
+  '''
+  options = effective_scan_options(scan_options, jobs = jobs)
+  if options.get('learn_regions', False) != scan_options.get('learn_regions', False):
+    log.warning('Learned regions are not applied on pipeline scans, searching configured regions.')
+  scan_options = options
+
+  salt = cache_salt(scan_options)
+  if cache:
+    state_logs = scanner_cache.load_state_logs(video_file, salt = salt)
+    if state_logs is not None:
+      return state_logs
 
-def scan_video_timing(video_file : str):
   opts = {}
   # opts['seek_option'] = (cv.CAP_PROP_POS_FRAMES, 13500)
-  with scanner_task.Scanner(video_file, **opts) as (scanner, video):
-    for scan_state in scanner:
-      scan_state.process()
-  # print(scanner.state_logs)
+  opts['prefetch'] = scan_options.get('prefetch', 0)
+  opts['backend'] = scan_options.get('decoder', 'opencv')
+  opts['decode_options'] = {}
+  if opts['backend'] != 'opencv':
+    opts['decode_options']['threads'] = scan_options.get('decoder_threads', 0)
+    if scan_options.get('luma', False):
+      opts['decode_options']['pix_fmt'] = 'yuv420p'
+  elif scan_options.get('luma', False):
+    log.warning('Luma scanning requires FFMPEG decoder, scanning in color.')
+  opts['detection_height'] = scan_options.get('detection_height', 0)
+  opts['scale_markers'] = scan_options.get('scale_markers', False)
+  opts['match_engine'] = scan_options.get('match_engine', 'split')
+  opts['pyramid_match'] = scan_options.get('pyramid_match', False)
+  opts['learn_regions'] = scan_options.get('learn_regions', False)
+  if 'region_widen_span' in scan_options:
+    opts['region_widen_span'] = scan_options['region_widen_span']
+  opts['sampling_cadence'] = scan_options.get('sampling_cadence', False)
+  opts['batch_frames'] = scan_options.get('batch_frames', 0)
+  if jobs <= 1:
+    # processes already occupy the cores
+    opts['marker_threads'] = scan_options.get('marker_threads', 0)
+  if scan_options.get('marker_schedule'):
+    opts['marker_schedule'] = scan_options['marker_schedule']
+  if opts['backend'] != 'opencv' and opts['detection_height'] > 0:
+    # scaled by the decoder instead
+    opts['decode_options']['scale'] = (0, opts['detection_height'])
+  if scan_options.get('probe_interval', 0) > 1:
+    state_logs = scanner_coarse.scan_video_refined(video_file, probe_interval = scan_options['probe_interval'], **opts)
+  elif jobs > 1:
+    state_logs = scanner_chunk.scan_video_chunked(video_file, jobs = jobs, **opts)
+  elif scan_options.get('pipeline_workers', 0) > 0:
+    state_logs = scanner_pipeline.scan_video_pipeline(video_file, workers = scan_options['pipeline_workers'], **opts)
+  else:
+    with scanner_task.Scanner(video_file, **opts) as (scanner, video):
+      for scan_state in scanner:
+        scan_state.process()
+    # print(scanner.state_logs)
+    state_logs = scanner.state_logs
+
+  if cache:
+    scanner_cache.store_state_logs(video_file, state_logs, salt = salt)
+
+  return state_logs
+
+def scan_video_timing_batch(video_files : list[str], *, jobs : int = 1, cache : bool = True, **scan_options):
+  '''
+  Scans multiple video files, returns state logs and errors of each file.
+  '''
+  results, errors = {}, {}
+  if cache:
+    # files of a batch are scanned on one process each
+    salt = cache_salt(effective_scan_options(scan_options, jobs = jobs if len(video_files) <= 1 else 1))
+    results.update(
+      (fn, state_logs)
+      for fn, state_logs in ((fn, scanner_cache.load_state_logs(fn, salt = salt)) for fn in video_files)
+      if state_logs is not None
+    )
+  video_files = [fn for fn in video_files if fn not in results]
+
+  if len(video_files) <= 1:
+    results.update((fn, scan_video_timing(fn, jobs = jobs, cache = cache, **scan_options)) for fn in video_files)
+  elif jobs <= 1:
+    for fn in video_files:
+      try:
+        results[fn] = scan_video_timing(fn, cache = cache, **scan_options)
+      except Exception as e:
+        log.error('Failed to scan %s.', fn, exc_info=True)
+        errors[fn] = repr(e)
+  else:
+    # processes already occupy the cores
+    batch_results, batch_errors = scanner_batch.scan_video_batch(
+      video_files, scan_video_timing,
+      jobs = jobs, threads = scan_options.get('batch_threads', False),
+      cache = cache, **{**scan_options, 'marker_threads': 0},
+    )
+    results.update(batch_results)
+    errors.update(batch_errors)
 
-  return scanner.state_logs
+  return results, errors
 
 def create_filter_script_raid(
   output_file : str,
@@ -1,13 +1,23 @@
 from . import (
+  frame,
   marker,
+  matching,
+  cascade,
+  roi,
   state,
   detect,
   frame_hooks,
   task,
+  chunk,
+  batch,
+  cache,
+  coarse,
+  pipeline,
   utils,
 )
 
 __all__ = (
-  'marker', 'state', 'detect',
-  'frame_hooks', 'task', 'utils',
+  'frame', 'marker', 'matching', 'cascade', 'roi', 'state', 'detect',
+  'frame_hooks', 'task', 'chunk', 'batch', 'cache',
+  'coarse', 'pipeline', 'utils',
 )
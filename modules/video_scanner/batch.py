@@ -0,0 +1,136 @@
+import os
+import logging
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2 as cv
+
+from .capture import probe_stream
+
+log = logging.getLogger(__name__)
+
+# Decoded frames a scanning process holds at once (decoder references, caches, working copies).
+DECODER_FRAME_BUFFERS = 32
+# Memory used by a scanning process regardless of resolution (runtime, markers).
+WORKER_BASE_MEMORY = 256 * 2 ** 20
+# Assumed resolution when a file cannot be probed.
+FALLBACK_RESOLUTION = (1920, 1080)
+
+@dataclass(slots=True, frozen=True)
+class VideoProbe():
+  '''
+  Container information used to schedule a scan.
+  '''
+  file : str
+  duration : float
+  width : int
+  height : int
+
+  @property
+  def worker_memory(self) -> int:
+    return WORKER_BASE_MEMORY + self.width * self.height * 3 * DECODER_FRAME_BUFFERS
+
+def probe_video(file : str) -> VideoProbe:
+  '''
+  Probes container duration and resolution of a video file.
+
+  Unreadable files are reported as empty so they are scheduled last.
+  '''
+  try:
+    stream = probe_stream(file)
+    return VideoProbe(file, stream['duration'], stream['width'], stream['height'])
+  except Exception:
+    log.warning('Failed to probe %s.', file, exc_info=True)
+    return VideoProbe(file, 0.0, *FALLBACK_RESOLUTION)
+
+def available_memory() -> int | None:
+  '''
+  Obtains available physical memory, if the platform tells it.
+  '''
+  try:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+  except (AttributeError, ValueError, OSError):
+    return None
+
+def plan_workers(probes : list[VideoProbe], jobs : int) -> int:
+  '''
+  Determines process count for given files, capped by cores and memory.
+  '''
+  workers = min(jobs, os.cpu_count() or 1, len(probes))
+  memory = available_memory()
+  if memory is not None and probes:
+    workers = min(workers, memory // max(probe.worker_memory for probe in probes))
+
+  return max(1, workers)
+
+def run_batch(
+  probes : list[VideoProbe], scan, workers : int, scan_options : dict, *,
+  threads : bool = False,
+) -> tuple[dict[str, object], dict[str, str], list[VideoProbe]]:
+  '''
+  Scans files on a process pool, or a thread pool sharing loaded markers.
+
+  Thread pool scans split the cores between OpenCV threads of each scan.
+  Returns results, errors and files left unscanned due to broken pool.
+  '''
+  results, errors, broken = {}, {}, []
+  opencv_threads = None
+  if threads:
+    opencv_threads = cv.getNumThreads()
+    cv.setNumThreads(max(1, (os.cpu_count() or 1) // workers))
+
+  executor_class = ThreadPoolExecutor if threads else ProcessPoolExecutor
+  try:
+    with executor_class(max_workers=workers) as executor:
+      futures = {
+        executor.submit(scan, probe.file, **scan_options): probe
+        for probe in probes
+      }
+      for future in as_completed(futures):
+        probe = futures[future]
+        try:
+          results[probe.file] = future.result()
+        except BrokenProcessPool:
+          broken.append(probe)
+        except Exception as e:
+          log.error('Failed to scan %s.', probe.file, exc_info=True)
+          errors[probe.file] = repr(e)
+  finally:
+    if opencv_threads is not None:
+      cv.setNumThreads(opencv_threads)
+
+  return results, errors, broken
+
+def scan_video_batch(
+  files : list[str], scan, *, jobs : int, threads : bool = False, **scan_options,
+) -> tuple[dict[str, object], dict[str, str]]:
+  '''
+  Scans multiple video files concurrently, longest file first.
+
+  A file failing to scan is reported in errors without stopping others.
+  Files caught in a crashed worker are rescanned one process each,
+  so only the offending file is lost.
+
+  Threads share one process, loaded markers and OpenCV runtime,
+  as every scan creates its own detectors.
+  '''
+  probes = sorted((probe_video(file) for file in files), key=lambda probe: probe.duration, reverse=True)
+  workers = plan_workers(probes, jobs)
+  log.info('Scanning %d file(s) on %d %s.', len(probes), workers, 'thread(s)' if threads else 'process(es)')
+
+  results, errors, broken = run_batch(probes, scan, workers, scan_options, threads = threads)
+  for probe in broken:
+    log.warning('Worker crashed while scanning %s, retrying in isolation.', probe.file)
+    retry_results, retry_errors, retry_broken = run_batch([probe], scan, 1, scan_options)
+    results.update(retry_results)
+    errors.update(retry_errors)
+    errors.update((retry.file, 'worker process crashed') for retry in retry_broken)
+
+  return results, errors
+
+__all__ = (
+  'VideoProbe',
+  'probe_video', 'plan_workers',
+  'scan_video_batch',
+)
@@ -0,0 +1,199 @@
+'''
+Micro-benchmarks of scanner internals.
+
+Run as `python -m modules.video_scanner.benchmark <name>`.
+'''
+import random
+import functools
+import logging
+import argparse
+import timeit
+from collections import deque
+from types import SimpleNamespace
+
+import numpy as np
+import cv2 as cv
+
+from modules.utils import setup_logging
+from . import utils
+
+log = logging.getLogger(__name__)
+
+def generate_skips(count : int, seed : int = 0) -> list[int]:
+  '''
+  Generates skip counts resembling a scan, bursts of short skips between static scenes.
+  '''
+  rng = random.Random(seed)
+  skips = []
+  while len(skips) < count:
+    if rng.random() < 0.2:
+      skips.extend(rng.choice((0, 0, 1, 2, 3)) for _ in range(rng.randint(10, 60)))
+    else:
+      skips.extend(rng.choice((0, rng.randint(1, 400))) for _ in range(rng.randint(1, 10)))
+
+  return skips[:count]
+
+def benchmark_skip_threshold(args):
+  '''
+  Compares incremental skip history against rebuilding the history every frame.
+  '''
+  skips = generate_skips(args.frames)
+
+  def run_reference():
+    scanner = SimpleNamespace(skip_history=deque(maxlen=100))
+    thresholds = []
+    for skip in skips:
+      thresholds.append(utils.calculate_similarity_threshold(scanner, 98.0, 0.15))
+      scanner.skip_history.append(skip)
+    return thresholds
+
+  def run_incremental():
+    history = utils.SkipHistory(100)
+    thresholds = []
+    for skip in skips:
+      thresholds.append(history.similarity_threshold(98.0, 0.15))
+      history.append(skip)
+    return thresholds
+
+  if run_reference() != run_incremental():
+    raise AssertionError('incremental skip history yields different thresholds')
+
+  for name, f in (('reference', run_reference), ('incremental', run_incremental)):
+    elapsed = min(timeit.repeat(f, number=1, repeat=args.repeat))
+    log.info('%-12s %8.3f ms total, %6.2f us/frame', name, 1e3 * elapsed, 1e6 * elapsed / len(skips))
+
+def synthesize_frame(marker, size : tuple[int, int], rng : np.random.Generator) -> np.ndarray:
+  '''
+  Generates a noisy frame with given marker blended somewhere in it.
+  '''
+  width, height = size
+  frame = cv.GaussianBlur(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), (9, 9), 0)
+  x, y = rng.integers(0, width - marker.width + 1), rng.integers(0, height - marker.height + 1)
+  alpha = np.ones((marker.height, marker.width, 1)) if marker.alpha_channel is None else marker.alpha_channel[..., None] / 255
+  window = frame[y:y + marker.height, x:x + marker.width]
+  window[:] = (alpha * marker.color_channel + (1 - alpha) * window).astype(np.uint8)
+  return frame
+
+# Largest score difference allowed between a matching engine and `cv.matchTemplate`.
+MATCH_SCORE_TOLERANCE = 1e-4
+
+def reference_scores(frame : np.ndarray, marker, single_color_mode : bool) -> np.ndarray:
+  '''
+  Computes `cv.matchTemplate` scores of every channel separately, averaged without stopping at invalid scores.
+  '''
+  if frame.ndim == 2:
+    channels, templates = (frame,), (marker.luma_channel,)
+  elif single_color_mode:
+    channels = (cv.cvtColor(frame, cv.COLOR_RGB2GRAY),)
+    templates = (marker.gray_channel,)
+  else:
+    channels, templates = cv.split(frame), marker.color_channels
+
+  return sum(
+    cv.matchTemplate(channel, template, cv.TM_CCOEFF_NORMED, mask=marker.alpha_channel)
+    for channel, template in zip(channels, templates)
+  ) / len(templates)
+
+def compare_scores(reference : np.ndarray, result : np.ndarray) -> tuple[float, int]:
+  '''
+  Compares score maps on windows where the reference is a valid score.
+
+  Masked `cv.matchTemplate` scores windows without enough variance as non-finite
+  or beyond [-1, 1], which matching engines clamp instead.
+  Returns largest difference and count of windows left out.
+  '''
+  if not np.isfinite(result).all():
+    raise AssertionError('matching yields non-finite scores')
+  with np.errstate(invalid='ignore'):
+    comparable = np.abs(reference) <= 1 + MATCH_SCORE_TOLERANCE
+  if not comparable.any():
+    return 0.0, reference.size
+  return float(np.abs(reference - result)[comparable].max()), int(reference.size - comparable.sum())
+
+def benchmark_marker_match(args, *, single_color_mode : bool = False):
+  '''
+  Compares matching engines against `cv.matchTemplate` matching every channel separately.
+
+  Scores of every engine must stay within `MATCH_SCORE_TOLERANCE` of the reference.
+  Single color mode is compared on luma frames as well.
+  Each marker is measured on a frame with it and a frame with the next marker,
+  every match is timed once as 1080p matching takes up to a second.
+  '''
+  from .frame import FrameFeatures
+  from .marker import Markers, match_marker
+
+  rng = np.random.default_rng(0)
+  size = (args.width, args.height)
+  markers = sorted(
+    (name, marker)
+    for name, marker in Markers.items()
+    if marker.width <= size[0] and marker.height <= size[1]
+  )
+  marker_frames = [synthesize_frame(marker, size, rng) for _, marker in markers]
+  engines = ('split', 'fused', 'fft')
+  failures = []
+
+  for i, (name, marker) in enumerate(markers):
+    # found and not found frames
+    frames = [marker_frames[i], marker_frames[(i + 1) % len(markers)]]
+    if single_color_mode:
+      frames += [cv.cvtColor(frame, cv.COLOR_BGR2GRAY) for frame in frames]
+
+    timings = dict.fromkeys(engines, 0.0)
+    max_difference = dict.fromkeys(engines[1:], 0.0)
+    skipped_windows = skipped_frames = 0
+    for frame in frames:
+      results = {}
+      for engine in engines:
+        started = timeit.default_timer()
+        results[engine] = match_marker(FrameFeatures(frame), marker, single_color_mode = single_color_mode, engine = engine)
+        timings[engine] += timeit.default_timer() - started
+
+      reference = reference_scores(frame, marker, single_color_mode)
+      for engine in engines[1:]:
+        difference, skipped = compare_scores(reference, results[engine])
+        max_difference[engine] = max(max_difference[engine], difference)
+      skipped_windows += skipped
+      skipped_frames += skipped == reference.size
+
+    log.info(
+      '%-28s %s, max score difference %s', name,
+      ', '.join(f'{engine} {1e3 * timings[engine] / len(frames):8.2f} ms' for engine in engines),
+      ', '.join(f'{engine} {difference:.2e}' for engine, difference in max_difference.items()),
+    )
+    if skipped_windows:
+      log.warning(
+        '%-28s %d window(s) with invalid reference scores left out, %d of %d frame(s) entirely.',
+        name, skipped_windows, skipped_frames, len(frames),
+      )
+    failures.extend(
+      f'{name} ({engine}, {difference:.2e})'
+      for engine, difference in max_difference.items()
+      if difference > MATCH_SCORE_TOLERANCE
+    )
+    if skipped_frames == len(frames):
+      failures.append(f'{name} (no comparable frame)')
+
+  if failures:
+    raise AssertionError(f'scores differ from the reference beyond {MATCH_SCORE_TOLERANCE:.0e}: {", ".join(failures)}')
+
+BENCHMARKS = {
+  'skip-threshold': benchmark_skip_threshold,
+  'color-match': benchmark_marker_match,
+  'gray-match': functools.partial(benchmark_marker_match, single_color_mode = True),
+}
+
+def main():
+  parser = argparse.ArgumentParser(description='Micro-benchmarks of scanner internals.')
+  parser.add_argument('benchmark', choices=tuple(BENCHMARKS))
+  parser.add_argument('--frames', type=int, default=20000, help='Number of frames to simulate.')
+  parser.add_argument('--repeat', type=int, default=5, help='Number of runs, fastest run is reported.')
+  parser.add_argument('--width', type=int, default=1920, help='Frame width of matching benchmarks.')
+  parser.add_argument('--height', type=int, default=1080, help='Frame height of matching benchmarks.')
+  args = parser.parse_args()
+
+  setup_logging(log)
+  BENCHMARKS[args.benchmark](args)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,121 @@
+import os
+import glob
+import json
+import hashlib
+import logging
+import functools
+
+from modules.types import Fraction
+from .marker import MARKER_FOLDER
+from .state import VideoState, VideoFrameEvent
+from .task_data import StateData
+from . import task
+
+log = logging.getLogger(__name__)
+
+CACHE_FOLDER = os.path.join('_cache', 'scan')
+# Bytes read from each of the start, middle and end of a video file.
+FINGERPRINT_BLOCK_SIZE = 4 * 2 ** 20
+CACHE_VERSION = 1
+
+def fingerprint_file(file : str) -> str:
+  '''
+  Fast partial content hash of a file.
+
+  Only hashes the file size and three blocks spread across the file.
+  '''
+  size = os.path.getsize(file)
+  digest = hashlib.blake2b(str(size).encode(), digest_size=20)
+  with open(file, 'rb') as f:
+    for offset in sorted({0, max(0, size // 2 - FINGERPRINT_BLOCK_SIZE // 2), max(0, size - FINGERPRINT_BLOCK_SIZE)}):
+      f.seek(offset)
+      digest.update(f.read(FINGERPRINT_BLOCK_SIZE))
+
+  return digest.hexdigest()
+
+@functools.cache
+def fingerprint_detectors() -> str:
+  '''
+  Hash of everything that decides the scan result of a video.
+
+  Covers detection markers, marker settings, thresholds and
+  the scanner source itself, so any change to detection invalidates entries.
+  '''
+  digest = hashlib.blake2b(str(CACHE_VERSION).encode(), digest_size=20)
+  for fn in sorted(glob.iglob('*.png', root_dir = MARKER_FOLDER)):
+    digest.update(fn.encode())
+    with open(os.path.join(MARKER_FOLDER, fn), 'rb') as f:
+      digest.update(f.read())
+
+  digest.update(repr(VideoFrameEvent.default_marker_settings).encode())
+  digest.update(repr(sorted(VideoFrameEvent.specific_marker_settings.items())).encode())
+  digest.update(repr(task.FRAME_SKIP_SIMILAR_THRESHOLD).encode())
+
+  source_dir = os.path.dirname(__file__)
+  for fn in sorted(glob.iglob('*.py', root_dir = source_dir)):
+    with open(os.path.join(source_dir, fn), 'rb') as f:
+      digest.update(f.read())
+
+  return digest.hexdigest()
+
+def cache_path(file : str, kind : str, salt : str = '') -> str:
+  key = hashlib.blake2b(
+    '\0'.join((fingerprint_file(file), fingerprint_detectors(), kind, salt)).encode(),
+    digest_size=20,
+  ).hexdigest()
+  return os.path.join(CACHE_FOLDER, kind, key + '.json')
+
+def load(file : str, kind : str, *, salt : str = ''):
+  '''
+  Loads cached payload of a file, returns None if not cached.
+  '''
+  try:
+    path = cache_path(file, kind, salt)
+    if not os.path.exists(path):
+      return None
+    with open(path) as f:
+      payload = json.load(f)
+  except (OSError, ValueError):
+    log.warning('Failed to load %s cache of %s.', kind, file, exc_info=True)
+    return None
+
+  log.info('Using cached %s of %s.', kind, file)
+  return payload
+
+def store(file : str, kind : str, payload, *, salt : str = ''):
+  '''
+  Stores payload of a file into cache.
+  '''
+  try:
+    path = cache_path(file, kind, salt)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+      json.dump(payload, f)
+    os.replace(path + '.tmp', path)
+  except OSError:
+    log.warning('Failed to store %s cache of %s.', kind, file, exc_info=True)
+
+def encode_state_logs(state_logs : list[StateData]) -> list:
+  return [
+    [list(state_log.time), {state.name: value for state, value in state_log.states.items()}]
+    for state_log in state_logs
+  ]
+
+def decode_state_logs(payload : list) -> list[StateData]:
+  return [
+    StateData(Fraction(*time), {VideoState[name]: value for name, value in states.items()})
+    for time, states in payload
+  ]
+
+def load_state_logs(file : str, *, salt : str = '') -> list[StateData] | None:
+  payload = load(file, 'states', salt = salt)
+  return decode_state_logs(payload) if payload is not None else None
+
+def store_state_logs(file : str, state_logs : list[StateData], *, salt : str = ''):
+  store(file, 'states', encode_state_logs(state_logs), salt = salt)
+
+__all__ = (
+  'fingerprint_file', 'fingerprint_detectors',
+  'load', 'store',
+  'load_state_logs', 'store_state_logs',
+)
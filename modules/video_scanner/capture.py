@@ -0,0 +1,335 @@
+import json
+import queue
+import shutil
+import logging
+import threading
+import contextlib
+import subprocess
+from fractions import Fraction as RationalFraction
+
+import numpy as np
+import cv2 as cv
+
+from .frame import LumaFrame, normalized_width
+
+log = logging.getLogger(__name__)
+
+# Upper bound of memory held by decoded frames waiting in the prefetch queue.
+PREFETCH_MEMORY_LIMIT = 512 * 2 ** 20
+
+class PrefetchCapture():
+  '''
+  Prefetching video reader.
+
+  Wraps a VideoCapture object and decodes frames on a background thread
+  into a bounded queue, along with their position and timestamp.
+  Exposes the VideoCapture methods used by the Scanner.
+  '''
+
+  def __init__(self, capture, depth : int = 8, *, memory_limit : int = PREFETCH_MEMORY_LIMIT):
+    self.capture = capture
+    self.properties = {
+      prop: capture.get(prop)
+      for prop in (
+        cv.CAP_PROP_FPS, cv.CAP_PROP_FRAME_COUNT,
+        cv.CAP_PROP_FRAME_WIDTH, cv.CAP_PROP_FRAME_HEIGHT,
+      )
+    }
+    self.position = (capture.get(cv.CAP_PROP_POS_FRAMES), capture.get(cv.CAP_PROP_POS_MSEC))
+
+    frame_bytes = int(self.properties[cv.CAP_PROP_FRAME_WIDTH] * self.properties[cv.CAP_PROP_FRAME_HEIGHT] * 3)
+    self.depth = max(1, min(depth, memory_limit // max(1, frame_bytes)))
+    if self.depth < depth:
+      log.debug('Prefetch depth reduced from %d to %d frames due to memory limit.', depth, self.depth)
+
+    self.frames = None
+    self.stop_event = None
+    self.thread = None
+    self.start()
+
+  def start(self):
+    '''
+    Starts the decoding thread.
+    '''
+    self.frames = queue.Queue(maxsize=self.depth)
+    self.stop_event = threading.Event()
+    self.thread = threading.Thread(
+      target=self.decode_frames,
+      args=(self.frames, self.stop_event),
+      name='PrefetchCapture',
+      daemon=True,
+    )
+    self.thread.start()
+
+  def stop(self):
+    '''
+    Stops the decoding thread, discarding prefetched frames.
+    '''
+    if self.thread is None:
+      return
+    self.stop_event.set()
+    while self.thread.is_alive():
+      with contextlib.suppress(queue.Empty):
+        self.frames.get(timeout=0.05)
+    self.thread.join()
+    self.thread = None
+
+  def decode_frames(self, frames : queue.Queue, stop_event : threading.Event):
+    while not stop_event.is_set():
+      try:
+        ret, frame = self.capture.read()
+      except Exception:
+        log.error('Failed to decode frame, ending stream.', exc_info=True)
+        ret, frame = False, None
+      item = (ret, frame, self.capture.get(cv.CAP_PROP_POS_FRAMES), self.capture.get(cv.CAP_PROP_POS_MSEC))
+      while not stop_event.is_set():
+        try:
+          frames.put(item, timeout=0.05)
+          break
+        except queue.Full:
+          continue
+      if not ret:
+        break
+
+  def read(self):
+    if self.thread is None:
+      return False, None
+    ret, frame, *self.position = self.frames.get()
+    if not ret:
+      # keeps returning end of stream
+      self.frames.put((ret, frame, *self.position))
+    return ret, frame
+
+  def grab(self):
+    ret, _ = self.read()
+    return ret
+
+  def get(self, prop):
+    if prop == cv.CAP_PROP_POS_FRAMES:
+      return self.position[0]
+    if prop == cv.CAP_PROP_POS_MSEC:
+      return self.position[1]
+    if prop in self.properties:
+      return self.properties[prop]
+    return self.capture.get(prop)
+
+  def set(self, prop, value):
+    self.stop()
+    result = self.capture.set(prop, value)
+    self.position = (self.capture.get(cv.CAP_PROP_POS_FRAMES), self.capture.get(cv.CAP_PROP_POS_MSEC))
+    self.start()
+    return result
+
+  def isOpened(self):
+    return self.capture.isOpened()
+
+  def release(self):
+    self.stop()
+    self.capture.release()
+
+class FFmpegCapture():
+  '''
+  FFmpeg rawvideo pipe reader.
+
+  Decodes a video file through an FFmpeg process, which applies scaling,
+  frame rate and pixel format filters with its own threads before
+  frames reach Python. Exposes the VideoCapture methods used by the Scanner,
+  frame positions follow the filtered output.
+
+  The yuv420p pixel format yields luma frames, see `frame.LumaFrame`.
+  Scale width of 0 keeps aspect ratio of the source.
+  '''
+
+  pixel_channels = {
+    'bgr24': 3,
+    'gray': 1,
+    'yuv420p': 1,
+  }
+
+  def __init__(
+    self, file : str, *,
+    scale : tuple[int, int] | None = None,
+    fps : float | None = None,
+    pix_fmt : str = 'bgr24',
+    threads : int = 0,
+  ):
+    if pix_fmt not in self.pixel_channels:
+      raise ValueError(f'unsupported pixel format {pix_fmt}')
+
+    self.file = file
+    self.pix_fmt = pix_fmt
+    self.threads = threads
+    self.fps_filter = fps
+    self.scale_filter = scale
+
+    self.source = probe_stream(file)
+    if scale is not None and scale[0] <= 0:
+      # width follows aspect ratio of the source
+      scale = (normalized_width(self.source['width'], self.source['height'], scale[1]), scale[1])
+      self.scale_filter = scale
+    self.width, self.height = scale if scale is not None else (self.source['width'], self.source['height'])
+    self.fps = fps if fps is not None else self.source['fps']
+    self.frame_total = int(self.source['duration'] * self.fps) if fps is not None or not self.source['frames'] else self.source['frames']
+
+    channels = self.pixel_channels[pix_fmt]
+    if pix_fmt == 'yuv420p':
+      self.frame_shape = (self.height * 3 // 2, self.width)
+    elif channels > 1:
+      self.frame_shape = (self.height, self.width, channels)
+    else:
+      self.frame_shape = (self.height, self.width)
+    self.frame_bytes = int(np.prod(self.frame_shape))
+
+    self.process = None
+    self.position = 0
+    self.scratch = bytearray(self.frame_bytes)
+    self.open(0)
+
+  def command(self, start_frame : int) -> list[str]:
+    filters = []
+    if self.scale_filter is not None:
+      filters.append('scale={0}:{1}'.format(*self.scale_filter))
+    if self.fps_filter is not None:
+      filters.append(f'fps={self.fps_filter}')
+    filters.append(f'format={self.pix_fmt}')
+
+    args = ['ffmpeg', '-loglevel', 'error', '-nostdin', '-threads', str(self.threads)]
+    if start_frame > 0:
+      args.extend(['-ss', f'{start_frame / self.fps:.6f}'])
+    args.extend([
+      '-i', self.file,
+      '-an', '-sn',
+      '-vf', ','.join(filters),
+      '-threads', str(self.threads),
+      '-f', 'rawvideo', '-pix_fmt', self.pix_fmt,
+      'pipe:1',
+    ])
+    return args
+
+  def open(self, start_frame : int):
+    self.close()
+    self.process = subprocess.Popen(
+      self.command(start_frame),
+      stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+      bufsize=self.frame_bytes * 2,
+    )
+    self.position = start_frame
+
+  def close(self):
+    if self.process is None:
+      return
+    self.process.kill()
+    self.process.stdout.close()
+    self.process.wait()
+    self.process = None
+
+  def read_into(self, buffer) -> bool:
+    view = memoryview(buffer).cast('B')
+    offset = 0
+    while offset < self.frame_bytes:
+      count = self.process.stdout.readinto(view[offset:])
+      if not count:
+        return False
+      offset += count
+
+    self.position += 1
+    return True
+
+  def read(self):
+    if self.process is None:
+      return False, None
+    frame = np.empty(self.frame_shape, dtype=np.uint8)
+    if not self.read_into(frame):
+      return False, None
+    if self.pix_fmt == 'yuv420p':
+      return True, LumaFrame(frame, self.height)
+    return True, frame
+
+  def grab(self):
+    if self.process is None:
+      return False
+    return self.read_into(self.scratch)
+
+  def get(self, prop):
+    return {
+      cv.CAP_PROP_POS_FRAMES: self.position,
+      cv.CAP_PROP_POS_MSEC: 1000 * self.position / self.fps,
+      cv.CAP_PROP_FPS: self.fps,
+      cv.CAP_PROP_FRAME_COUNT: self.frame_total,
+      cv.CAP_PROP_FRAME_WIDTH: self.width,
+      cv.CAP_PROP_FRAME_HEIGHT: self.height,
+    }.get(prop, 0)
+
+  def set(self, prop, value):
+    if prop == cv.CAP_PROP_POS_FRAMES:
+      self.open(int(value))
+    elif prop == cv.CAP_PROP_POS_MSEC:
+      self.open(int(value * self.fps / 1000))
+    else:
+      return False
+    return True
+
+  def isOpened(self):
+    return self.process is not None
+
+  def release(self):
+    self.close()
+
+def probe_stream(file : str) -> dict:
+  '''
+  Probes first video stream dimensions, frame rate and length.
+  '''
+  process = subprocess.run([
+    'ffprobe',
+    '-loglevel', '16',
+    '-select_streams', 'v:0',
+    '-show_entries', 'stream=width,height,avg_frame_rate,r_frame_rate,nb_frames,duration:format=duration',
+    '-print_format', 'json',
+    file,
+  ], check=True, capture_output=True, text=True)
+  data = json.loads(process.stdout)
+  stream = data['streams'][0]
+
+  frame_rate = stream.get('avg_frame_rate', '0/0')
+  if frame_rate.endswith('/0'):
+    frame_rate = stream['r_frame_rate']
+
+  return {
+    'width': int(stream['width']),
+    'height': int(stream['height']),
+    'fps': float(RationalFraction(frame_rate)),
+    'frames': int(stream.get('nb_frames', 0) or 0),
+    'duration': float(stream.get('duration') or data['format']['duration']),
+  }
+
+CAPTURE_BACKENDS = ('opencv', 'ffmpeg', 'auto')
+
+def open_capture(file : str, backend : str = 'opencv', **decode_options):
+  '''
+  Opens a video file with given decoding backend.
+
+  Automatic backend prefers FFmpeg when it is installed and able to probe the file.
+  '''
+  if backend not in CAPTURE_BACKENDS:
+    raise ValueError(f'unknown capture backend {backend}')
+
+  if backend == 'auto':
+    backend = 'opencv'
+    if shutil.which('ffmpeg') and shutil.which('ffprobe'):
+      try:
+        return FFmpegCapture(file, **decode_options)
+      except (subprocess.CalledProcessError, LookupError, ValueError):
+        log.warning('FFMPEG is unable to read %s, using OpenCV.', file, exc_info=True)
+
+  if backend == 'ffmpeg':
+    return FFmpegCapture(file, **decode_options)
+
+  return cv.VideoCapture(file)
+
+__all__ = (
+  'PrefetchCapture',
+  'FFmpegCapture',
+  'CAPTURE_BACKENDS',
+  'open_capture',
+  'probe_stream',
+)
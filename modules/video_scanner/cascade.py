@@ -0,0 +1,161 @@
+import logging
+import threading
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+import numpy as np
+import cv2 as cv
+
+from .frame import FrameFeatures
+
+log = logging.getLogger(__name__)
+
+# Histogram bins per color channel.
+HISTOGRAM_BINS = 8
+# Canny thresholds of edge density stage.
+EDGE_THRESHOLDS = (100, 200)
+# Pyramid level of mean color stage.
+MEAN_LEVEL = 2
+
+# Prefilter settings, a stage set to None is skipped.
+DEFAULT_CASCADE = {
+  # largest distance between marker mean color and the closest window mean color, unmasked markers only
+  'mean_tolerance': 48.0,
+  # smallest part of marker color histogram found in the region histogram
+  'histogram_ratio': 0.5,
+  # smallest region edge pixels relative to marker edge pixels
+  'edge_ratio': 0.5,
+  # gray score below detection threshold by this much rejects color matching
+  'gray_margin': 0.15,
+}
+CASCADE_STAGES = ('mean', 'histogram', 'edge', 'gray')
+
+@dataclass(slots=True, frozen=True)
+class MarkerProfile():
+  '''
+  Cheap statistics of a marker for the prefilter stages.
+  '''
+  mean : np.ndarray | None
+  histogram : np.ndarray = field(repr=False)
+  edge_count : int
+
+def color_histogram(image : np.ndarray, mask : np.ndarray | None = None) -> np.ndarray:
+  return cv.calcHist([image], [0, 1, 2], mask, [HISTOGRAM_BINS] * 3, [0, 256] * 3).ravel()
+
+def profile_marker(color : np.ndarray, alpha : np.ndarray | None) -> MarkerProfile:
+  '''
+  Computes statistics of a marker, only opaque pixels are considered.
+  '''
+  mask = None if alpha is None else np.where(alpha > 0, 255, 0).astype(np.uint8)
+  edges = cv.Canny(cv.cvtColor(color, cv.COLOR_BGR2GRAY), *EDGE_THRESHOLDS)
+  if mask is not None:
+    # outline of the mask is not part of the marker
+    edges = cv.bitwise_and(edges, cv.erode(mask, np.ones((3, 3), dtype=np.uint8)))
+
+  return MarkerProfile(
+    None if mask is not None else np.array(cv.mean(color)[:3]),
+    color_histogram(color, mask),
+    int(np.count_nonzero(edges)),
+  )
+
+def check_mean(region : FrameFeatures, marker, tolerance : float) -> bool:
+  '''
+  Checks whether any marker-sized window has mean color close to the marker.
+  '''
+  coarse_region = region.pyramid(MEAN_LEVEL)
+  size = (marker.width >> MEAN_LEVEL, marker.height >> MEAN_LEVEL)
+  if marker.profile.mean is None or min(size) < 1 or \
+    coarse_region.shape[1] < size[0] or coarse_region.shape[0] < size[1]:
+    return True
+
+  means = coarse_region.derive(
+    ('window_means', size),
+    lambda: cv.boxFilter(coarse_region.frame.astype(np.float32), -1, size, anchor=(0, 0), borderType=cv.BORDER_CONSTANT)[
+      :coarse_region.shape[0] - size[1] + 1, :coarse_region.shape[1] - size[0] + 1,
+    ],
+  )
+  distance = np.sqrt(((means - marker.profile.mean.astype(np.float32)) ** 2).sum(axis=2))
+  return float(distance.min()) <= tolerance
+
+def check_histogram(region : FrameFeatures, marker, ratio : float) -> bool:
+  '''
+  Checks whether the region has enough pixels of each marker color.
+  '''
+  histogram = region.derive('color_histogram', lambda: color_histogram(region.frame))
+  contained = np.minimum(histogram, marker.profile.histogram).sum()
+  return contained >= ratio * marker.profile.histogram.sum()
+
+def check_edges(region : FrameFeatures, marker, ratio : float) -> bool:
+  '''
+  Checks whether the region has as many edges as the marker.
+  '''
+  edge_count = region.derive(
+    'edge_count',
+    lambda: int(np.count_nonzero(cv.Canny(region.gray(cv.COLOR_BGR2GRAY), *EDGE_THRESHOLDS))),
+  )
+  return edge_count >= ratio * marker.profile.edge_count
+
+def prefilter(region : FrameFeatures, marker, settings : dict, stats : 'CascadeStats | None' = None) -> str | None:
+  '''
+  Runs cheap rejection stages on a color region, returns the rejecting stage if any.
+
+  Stage outcomes are counted on given scan statistics.
+  '''
+  for stage, key, check in (
+    ('mean', 'mean_tolerance', check_mean),
+    ('histogram', 'histogram_ratio', check_histogram),
+    ('edge', 'edge_ratio', check_edges),
+  ):
+    if settings.get(key) is None:
+      continue
+    rejected = not check(region, marker, settings[key])
+    if stats is not None:
+      stats.record(marker.name, stage, rejected)
+    if rejected:
+      return stage
+
+  return None
+
+class CascadeStats():
+  '''
+  Evaluated and rejected counts of prefilter stages during a scan, by marker and stage.
+
+  Markers of a frame may be matched on several threads, counts are updated under a lock.
+  '''
+
+  def __init__(self):
+    self.counts : dict[tuple[str, str], list[int]] = defaultdict(lambda: [0, 0])
+    self.lock = threading.Lock()
+
+  def record(self, marker_name : str, stage : str, rejected : bool):
+    with self.lock:
+      counts = self.counts[marker_name, stage]
+      counts[0] += 1
+      counts[1] += rejected
+
+  def stage_stats(self) -> dict[str, dict[str, tuple[int, int, float]]]:
+    '''
+    Evaluated count, rejected count and reject rate of every stage, by marker.
+    '''
+    with self.lock:
+      counts = sorted((key, tuple(value)) for key, value in self.counts.items())
+    result = defaultdict(dict)
+    for (marker_name, stage), (evaluated, rejected) in counts:
+      result[marker_name][stage] = (evaluated, rejected, rejected / evaluated if evaluated else 0.0)
+    return dict(result)
+
+  def log(self, level : int = logging.DEBUG):
+    for marker_name, stages in self.stage_stats().items():
+      log.log(
+        level, 'Cascade %s: %s', marker_name,
+        ', '.join(
+          f'{stage} {rejected}/{evaluated} ({100 * rate:.1f}%)'
+          for stage, (evaluated, rejected, rate) in sorted(stages.items(), key=lambda item: CASCADE_STAGES.index(item[0]))
+        ),
+      )
+
+__all__ = (
+  'DEFAULT_CASCADE', 'CASCADE_STAGES',
+  'MarkerProfile', 'profile_marker',
+  'prefilter', 'CascadeStats',
+)
@@ -0,0 +1,147 @@
+import math
+import logging
+import functools
+import dataclasses
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2 as cv
+
+from .state import VideoState
+from .task_data import StateData
+from .task import Scanner, ScanSeed, open_video_file
+
+log = logging.getLogger(__name__)
+
+# Seconds scanned ahead of each chunk to warm up detector state.
+CHUNK_WARMUP_DURATION = 10
+# Chunks shorter than this amount of warmup are not worth splitting.
+CHUNK_MINIMUM_RATIO = 4
+
+@dataclass(slots=True, frozen=True)
+class ChunkPlan():
+  '''
+  Frame range of a video to scan.
+
+  Scanning begins at `warmup` and only state changes from `start` up to
+  (but excluding) `stop` are kept.
+  '''
+  index : int
+  warmup : int
+  start : int
+  stop : int | None
+
+@dataclass(slots=True)
+class ChunkResult():
+  '''
+  Scan result of a chunk.
+  '''
+  plan : ChunkPlan
+  state_logs : list[StateData] = field(repr=False)
+  boundary : ScanSeed | None = field(repr=False)
+  final : ScanSeed = field(repr=False)
+
+  def continues(self, previous : 'ChunkResult') -> bool:
+    '''
+    Checks whether the warmed up state matches the end state of previous chunk.
+    '''
+    if self.boundary is None:
+      return False
+    return all([
+      self.boundary.states == previous.final.states,
+      self.boundary.context == previous.final.context,
+    ])
+
+def plan_chunks(frame_total : int, frame_rate : float, jobs : int) -> list[ChunkPlan]:
+  '''
+  Splits a video frame range into overlapping chunks.
+  '''
+  warmup = int(CHUNK_WARMUP_DURATION * frame_rate)
+  chunk_count = max(1, min(jobs, frame_total // max(1, warmup * CHUNK_MINIMUM_RATIO)))
+  chunk_size = math.ceil(frame_total / chunk_count)
+
+  plans = []
+  for i in range(chunk_count):
+    start = i * chunk_size
+    stop = start + chunk_size if i < chunk_count - 1 else None
+    plans.append(ChunkPlan(i, max(0, start - warmup), start, stop))
+
+  return plans
+
+def scan_chunk(video_file : str, plan : ChunkPlan, *, seed : ScanSeed | None = None, **scanner_options) -> ChunkResult:
+  '''
+  Scans a chunk of the video file.
+
+  Meant to be called from a worker process.
+  '''
+  opts = dict(scanner_options)
+  opts['frame_limit'] = plan.stop
+  opts['seed'] = seed
+  if plan.warmup > 0:
+    opts['seek_option'] = (cv.CAP_PROP_POS_FRAMES, plan.warmup)
+
+  boundary = None
+  with Scanner(video_file, **opts) as (scanner, video):
+    for scan_state in scanner:
+      if boundary is None and scanner.frame_count >= plan.start:
+        boundary = scanner.snapshot(plan.start)
+      scan_state.process()
+    final = scanner.snapshot(plan.stop)
+
+  frame_rate = int(scanner.frame_rate)
+  state_logs = [
+    state_log
+    for state_log in scanner.state_logs
+    if state_log.time >= (plan.start, frame_rate) and
+      (plan.stop is None or VideoState.EOF not in state_log.states)
+  ]
+
+  return ChunkResult(plan, state_logs, boundary, final)
+
+def stitch_chunks(video_file : str, results : list[ChunkResult], **scanner_options) -> list[StateData]:
+  '''
+  Combines chunk results into one state timeline.
+
+  Chunks which warmed up into different states from the previous chunk
+  are scanned again, continuing from where previous chunk ends.
+  '''
+  state_logs = []
+  previous = None
+  for result in sorted(results, key=lambda result: result.plan.index):
+    if previous is not None and not result.continues(previous):
+      log.info('Chunk %d does not continue previous chunk state, rescanning.', result.plan.index)
+      plan = dataclasses.replace(result.plan, warmup=result.plan.start)
+      result = scan_chunk(video_file, plan, seed=previous.final, **scanner_options)
+
+    state_logs.extend(result.state_logs)
+    previous = result
+
+  return state_logs
+
+def scan_video_chunked(video_file : str, *, jobs : int, **scanner_options) -> list[StateData]:
+  '''
+  Scans a video file on multiple processes, by splitting it into chunks.
+  '''
+  with open_video_file(
+    video_file,
+    scanner_options.get('backend', 'opencv'),
+    **(scanner_options.get('decode_options') or {}),
+  ) as video:
+    frame_total = int(video.get(cv.CAP_PROP_FRAME_COUNT))
+    frame_rate = video.get(cv.CAP_PROP_FPS) or 30
+
+  plans = plan_chunks(frame_total, frame_rate, jobs)
+  log.info('Scanning %s in %d chunk(s).', video_file, len(plans))
+  if len(plans) == 1:
+    return scan_chunk(video_file, plans[0], **scanner_options).state_logs
+
+  with ProcessPoolExecutor(max_workers=len(plans)) as executor:
+    results = list(executor.map(functools.partial(scan_chunk, video_file, **scanner_options), plans))
+
+  return stitch_chunks(video_file, results, **scanner_options)
+
+__all__ = (
+  'ChunkPlan', 'ChunkResult',
+  'plan_chunks', 'scan_chunk', 'stitch_chunks',
+  'scan_video_chunked',
+)
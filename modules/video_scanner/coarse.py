@@ -0,0 +1,141 @@
+import logging
+from dataclasses import dataclass
+
+import cv2 as cv
+
+from .state import VideoFrameData, VideoFrameEvent, CADENCE_ALERT_SIMILARITY
+from .frame import FrameFeatures, normalize_frame
+from .task_data import StateData
+from .task import Scanner, open_video_file
+from .detect import CONTEXT_HORIZON
+
+log = logging.getLogger(__name__)
+# Similarity to the previous probe below this suggests a transition between probes.
+PROBE_ALERT_SIMILARITY = CADENCE_ALERT_SIMILARITY
+
+@dataclass(slots=True, frozen=True)
+class ProbeResult():
+  '''
+  Coarse state vector of a probed frame.
+  '''
+  frame : int
+  signature : tuple
+  # similarity to the previous probe, see `FrameFeatures.similarity`
+  similarity : float = 100.0
+
+def probe_signature(frame, frame_data : VideoFrameData) -> tuple:
+  '''
+  Computes state vector of a frame from stateless detections.
+
+  Consists of found markers and darkness of the frame.
+  '''
+  features = FrameFeatures(frame)
+  frame_event = VideoFrameEvent(frame_data, features)
+  frame_event.detect_markers_in_frame(frame)
+  found_markers = tuple(sorted(name for name, result in frame_event.marker_results.items() if result.ok))
+
+  return (found_markers, features.darkness(80))
+
+def probe_frames(
+  video_file : str, interval : int, *,
+  backend : str = 'opencv', decode_options : dict | None = None,
+  detection_height : int = 0, scale_markers : bool = False,
+  match_engine : str = 'split', pyramid_match : bool = False,
+) -> tuple[list[ProbeResult], int, float]:
+  '''
+  Probes every N-th frame of a video file.
+
+  Frames between probes are grabbed without being retrieved.
+  '''
+  probes = []
+  with open_video_file(video_file, backend, **(decode_options or {})) as video:
+    frame_total = int(video.get(cv.CAP_PROP_FRAME_COUNT))
+    frame_rate = video.get(cv.CAP_PROP_FPS) or 30
+    frame_data = VideoFrameData()
+    frame_data.params = {
+      'scale_markers': scale_markers or detection_height > 0,
+      'match_engine': match_engine,
+      'pyramid_match': pyramid_match,
+    }
+
+    previous = None
+    ret, frame = video.read()
+    while ret:
+      frame = normalize_frame(frame, detection_height)
+      position = int(video.get(cv.CAP_PROP_POS_FRAMES)) - 1
+      features = FrameFeatures(frame, previous)
+      probes.append(ProbeResult(position, probe_signature(frame, frame_data), features.similarity))
+      features.detach_previous()
+      previous = features
+
+      for _ in range(interval - 1):
+        if not video.grab():
+          break
+      ret, frame = video.read()
+
+  return probes, frame_total, frame_rate
+
+def plan_windows(probes : list[ProbeResult], interval : int, frame_rate : float) -> list[tuple[int, int | None]]:
+  '''
+  Determines frame ranges to scan frame-by-frame.
+
+  Ranges cover every probe interval where the state vector changed
+  or the frame changed much, extended for detectors that change states
+  some time after a transition.
+  '''
+  tail = int(CONTEXT_HORIZON * frame_rate)
+  windows = [(0, interval)]
+  for previous, current in zip(probes, probes[1:]):
+    if previous.signature != current.signature or current.similarity < PROBE_ALERT_SIMILARITY:
+      windows.append((max(0, previous.frame - interval), current.frame + tail))
+  windows.append((max(0, probes[-1].frame - interval) if probes else 0, None))
+
+  merged_windows = []
+  for start, stop in sorted(windows, key=lambda window: window[0]):
+    if merged_windows:
+      last_start, last_stop = merged_windows[-1]
+      if last_stop is None or start <= last_stop:
+        merged_windows[-1] = (last_start, None if last_stop is None or stop is None else max(last_stop, stop))
+        continue
+    merged_windows.append((start, stop))
+
+  return merged_windows
+
+def scan_video_refined(video_file : str, *, probe_interval : int, **opts) -> list[StateData]:
+  '''
+  Scans a video file in two phases.
+
+  First phase probes every N-th frame for its state vector.
+  Second phase scans frame-by-frame only around the probes where it changed.
+
+  States lasting shorter than the probe interval, such as a loading flash,
+  are only refined when the probes around them differ.
+  '''
+  probes, frame_total, frame_rate = probe_frames(
+    video_file, probe_interval,
+    backend = opts.get('backend', 'opencv'),
+    decode_options = opts.get('decode_options'),
+    detection_height = opts.get('detection_height', 0),
+    scale_markers = opts.get('scale_markers', False),
+    match_engine = opts.get('match_engine', 'split'),
+    pyramid_match = opts.get('pyramid_match', False),
+  )
+  windows = plan_windows(probes, probe_interval, frame_rate)
+  window_frames = sum((stop if stop is not None else frame_total) - start for start, stop in windows)
+  log.info(
+    'Refining %d window(s) of %s, covering %d of %d frames.',
+    len(windows), video_file, window_frames, frame_total,
+  )
+
+  with Scanner(video_file, frame_windows = windows, **opts) as (scanner, video):
+    for scan_state in scanner:
+      scan_state.process()
+
+  return scanner.state_logs
+
+__all__ = (
+  'PROBE_ALERT_SIMILARITY',
+  'ProbeResult',
+  'probe_frames', 'plan_windows',
+  'scan_video_refined',
+)
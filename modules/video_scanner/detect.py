@@ -1,15 +1,16 @@
-# ruff: noqa: F821
 import logging
 
 import numpy as np
-import cv2 as cv
 
 # from .marker import Markers
-from .state import VideoState, VideoFrameEvent
-from . import utils
+from .state import VideoState, VideoFrameEvent, Cadence, detector_registry
 
 log = logging.getLogger(__name__)
 
+# Frame-time window (in seconds) for carried detector context.
+# Anything older than this behaves the same for every time-based check.
+CONTEXT_HORIZON = 6
+
 class ColorCycle:
   _default_slope_point_ = 2
   _max_value_ = 255
@@ -43,8 +44,25 @@ class ColorCycle:
   def __exit__(self, ex_type, ex_value, ex_trace):
     return False
 
-def evaluate_now(f):
-  return f()
+def requires_markers(*markers : str):
+  '''
+  Declares markers a detector reads, only these are searched for it.
+  '''
+  def decorator(f):
+    f.__required_markers__ = markers
+    return f
+
+  return decorator
+
+def sampling_cadence(frames : int = 1, ms : float = 0):
+  '''
+  Declares how sparsely a detector may be sampled, see `state.SamplingSchedule`.
+  '''
+  def decorator(f):
+    f.__cadence__ = Cadence(frames, ms)
+    return f
+
+  return decorator
 
 def ensure_marker(*markers : str):
   def decorator(f):
@@ -53,16 +71,32 @@ def ensure_marker(*markers : str):
         return
       f(frame_event, frame)
     wrapper.__name__ = f.__name__
-    wrapper.__required_markers__ = markers
-    return wrapper
+    return requires_markers(*markers)(wrapper)
 
   return decorator
 
 def state_change_event(f):
-  if f not in VideoFrameEvent.state_change_events:
-    VideoFrameEvent.state_change_events.append(f)
+  detector_registry.register(f)
   return f
 
+def state_change_event_factory(factory):
+  '''
+  Registers detectors keeping state across frames, created again for every scan.
+  '''
+  detector_registry.register_factory(factory)
+  return factory
+
+def carried_context(export_context, import_context):
+  '''
+  Attach context transfer functions for detectors that carry state across frames.
+  '''
+  def decorator(f):
+    f.__export_context__ = export_context
+    f.__import_context__ = import_context
+    return f
+
+  return decorator
+
 @state_change_event
 @ensure_marker('formation-icons')
 def process_detect_unit_formation(frame_event : VideoFrameEvent, frame : np.ndarray):
@@ -86,6 +120,7 @@ def process_detect_loading_marker(frame_event, frame):
   frame_event[VideoState.LOADING_FLAG] = actual_found
 
 @state_change_event
+@requires_markers()
 def process_detect_loading_screen(frame_event, frame):
   def effective_flag(state):
     return frame_event[state] if frame_event[state] is not None else frame_event.frame_data[state]
@@ -124,22 +159,23 @@ def process_detect_gameplay_result(frame_event : VideoFrameEvent, frame : np.nda
   actual_found = any(result.ok for result in marker_results.values())
 
   for state, key, color in zip(states, keys, ColorCycle()):
-    marker_result = marker_results[key]
+    marker_result = marker_results.get(key)
 
-    if marker_result.ok and not frame_event.frame_data[state]:
+    if marker_result is not None and marker_result.ok and not frame_event.frame_data[state]:
       pass
 
   if actual_found:
     pass
 
+  # markers not matched on this frame keep their states, see `state.MarkerSchedule`
   frame_event.update(dict(
     (state, marker_results[key].ok)
     for state, key in zip(states, keys)
+    if key in marker_results
   ))
 
-@evaluate_now
+@state_change_event_factory
 def process_victory_screen():
-  last_frame = None
   last_state_time : dict[VideoState, int] = {}
 
   def state_recorded(state : VideoState, states_dict):
@@ -148,19 +184,39 @@ def process_victory_screen():
   def state_not_recorded(state : VideoState, states_dict):
     return state not in last_state_time
 
-  @state_change_event
+  def export_context(time):
+    n, fps = time
+    horizon = int(CONTEXT_HORIZON * fps)
+    return {
+      'last_state_age': {
+        state: min(horizon, n - recorded)
+        for state, recorded in last_state_time.items()
+      },
+    }
+
+  def import_context(context, time):
+    nonlocal last_state_time
+    n, fps = time
+    last_state_time = {
+      state: n - age
+      for state, age in context['last_state_age'].items()
+    }
+
+  @requires_markers()
+  @carried_context(export_context, import_context)
   def process_detect_victory_transition(frame_event : VideoFrameEvent, frame : np.ndarray):
-    nonlocal last_frame, last_state_time
+    nonlocal last_state_time
     frame_data = frame_event.frame_data
+    features = frame_event.features
     n, fps = frame_event.frame_data.params['time']
     if frame_data.params['first_frame']:
-      last_frame = frame
+      last_state_time = {}
 
     # do not process exact frame
-    if np.all(frame == last_frame):
+    if features.identical:
       return
 
-    score = utils.calculate_similarity(last_frame, frame)
+    score = features.similarity
     if state_recorded(VideoState.GAMEPLAY_DETECT, frame_data):
       frame_event[VideoState.GAMEPLAY_CONCLUDE_WAIT] = n > last_state_time[VideoState.GAMEPLAY_DETECT] + 5 * fps
 
@@ -176,9 +232,7 @@ def process_victory_screen():
     if frame_event[VideoState.GAMEPLAY_CONCLUDE_RESULT]:
       frame_event[VideoState.GAMEPLAY_CONCLUDE_WAIT] = False
 
-    last_frame = frame
-
-  @state_change_event
+  @requires_markers()
   def track_last_active_state(frame_event : VideoFrameEvent, frame : np.ndarray):
     nonlocal last_state_time
     n, fps = frame_event.frame_data.params['time']
@@ -190,45 +244,28 @@ def process_victory_screen():
       if v is True
     })
 
-  return process_detect_victory_transition
+  return process_detect_victory_transition, track_last_active_state
 
-@evaluate_now
+@state_change_event_factory
 def process_black_screen():
-  loading_mask = None
   ignore_first_change = True
-  @state_change_event
+
+  def export_context(time):
+    return {'ignore_first_change': ignore_first_change}
+
+  def import_context(context, time):
+    nonlocal ignore_first_change
+    ignore_first_change = context['ignore_first_change']
+
+  @requires_markers()
+  @sampling_cadence(ms=100)
+  @carried_context(export_context, import_context)
   def process_black_screen_check(frame_event : VideoFrameEvent, frame : np.ndarray):
-    nonlocal loading_mask, ignore_first_change
+    nonlocal ignore_first_change
     if frame_event.frame_data.params['first_frame']:
-      loading_mask = None
       ignore_first_change = True
 
-    def create_rectangle_mask(frame, offset, color):
-      mask = np.full(frame.shape[:2], 255, dtype='uint8')
-      cv.rectangle(
-        mask,
-        (offset, offset),
-        (frame.shape[0] - offset, frame.shape[1] - offset),
-        color,
-        -1,
-      )
-      return mask
-
-    # Darkness constants
-    DARK_VALUE_THRESHOLD = 5
-    DARK_DOMINANCE_THRESHOLD = 70
-    DARK_COMPLETE_THRESHOLD = 95
-
-    if loading_mask is None:
-      loading_mask = create_rectangle_mask(frame, 80, 0)
-
-    gray_frame = cv.cvtColor(frame, cv.COLOR_RGB2GRAY)
-    gray_hist  = cv.calcHist([gray_frame], [0], loading_mask, [256], [0, 256])
-
-    total_dark_pixels = gray_hist[:DARK_VALUE_THRESHOLD].sum()
-    ratio_dark_pixels = total_dark_pixels / gray_hist.sum()
-    is_gray_dark  = ratio_dark_pixels * 100 >= DARK_DOMINANCE_THRESHOLD
-    is_gray_black = ratio_dark_pixels * 100 >= DARK_COMPLETE_THRESHOLD
+    is_gray_dark, is_gray_black = frame_event.features.darkness(80)
 
     if ignore_first_change:
       frame_event.frame_data.states[VideoState.SCREEN_DARK], frame_event.frame_data.states[VideoState.SCREEN_BLACK] = is_gray_dark, is_gray_black
@@ -239,6 +276,7 @@ def process_black_screen():
       (VideoState.SCREEN_BLACK, is_gray_black),
     )
 
-  return process_black_screen_check
+  return (process_black_screen_check,)
 
-del ensure_marker, state_change_event
+# detector factories keep using the remaining decorators on every scan
+del ensure_marker, state_change_event, state_change_event_factory
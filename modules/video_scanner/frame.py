@@ -0,0 +1,220 @@
+import functools
+
+import numpy as np
+import cv2 as cv
+
+class LumaFrame(np.ndarray):
+  '''
+  Luma plane of a decoded YUV 4:2:0 frame.
+
+  Behaves as a grayscale image, while keeping the whole planar buffer
+  so the color frame is only converted once a detector asks for it.
+  '''
+
+  def __new__(cls, planes : np.ndarray, height : int):
+    frame = planes[:height].view(cls)
+    frame.planes = planes
+    frame.color_frame = None
+    return frame
+
+  def __array_finalize__(self, obj):
+    # derived arrays (crops, comparisons) no longer map to the planes
+    self.planes = None
+    self.color_frame = None
+
+  def color(self) -> np.ndarray:
+    '''
+    Converts the frame into BGR color, memoized.
+    '''
+    if self.planes is None:
+      return cv.cvtColor(np.asarray(self), cv.COLOR_GRAY2BGR)
+    if self.color_frame is None:
+      self.color_frame = cv.cvtColor(self.planes, cv.COLOR_YUV2BGR_I420)
+    return self.color_frame
+
+def normalize_frame(frame : np.ndarray, height : int) -> np.ndarray:
+  '''
+  Resizes a frame to given height keeping aspect ratio, width is kept even.
+  '''
+  if not height or frame.shape[0] == height:
+    return frame
+
+  source_height, source_width = frame.shape[:2]
+  width = normalized_width(source_width, source_height, height)
+  interpolation = cv.INTER_AREA if height < source_height else cv.INTER_LINEAR
+  if isinstance(frame, LumaFrame) and frame.planes is not None:
+    # resizes every plane of the YUV 4:2:0 buffer
+    planes = frame.planes
+    chroma_size = (source_height // 2, source_width // 2)
+    chroma_planes = planes[source_height:].reshape(2, *chroma_size)
+    resized = np.concatenate([
+      cv.resize(planes[:source_height], (width, height), interpolation=interpolation).ravel(),
+      *(cv.resize(plane, (width // 2, height // 2), interpolation=interpolation).ravel() for plane in chroma_planes),
+    ])
+    return LumaFrame(resized.reshape(height * 3 // 2, width), height)
+
+  return cv.resize(np.asarray(frame), (width, height), interpolation=interpolation)
+
+def normalized_width(width : int, height : int, target_height : int) -> int:
+  return max(2, round(width * target_height / height / 2) * 2)
+
+def gray_frame(frame : np.ndarray, code : int = cv.COLOR_BGR2GRAY) -> np.ndarray:
+  '''
+  Obtains grayscale image of a frame, luma frames are used as is.
+  '''
+  if frame.ndim == 2:
+    return frame
+  return cv.cvtColor(frame, code)
+
+def color_frame(frame : np.ndarray) -> np.ndarray:
+  '''
+  Obtains color image of a frame, converting luma frames when necessary.
+  '''
+  if isinstance(frame, LumaFrame):
+    return frame.color()
+  if frame.ndim == 2:
+    return cv.cvtColor(frame, cv.COLOR_GRAY2BGR)
+  return frame
+
+@functools.lru_cache(maxsize=8)
+def rectangle_mask(shape : tuple[int, int], offset : int) -> np.ndarray:
+  '''
+  Mask excluding a rectangle inset by given offset, see `utils.create_rectangle_mask`.
+
+  Shared by frames of the same shape, read only.
+  '''
+  from .utils import create_rectangle_mask
+  mask = create_rectangle_mask(np.empty(shape, dtype=np.uint8), offset, 0)
+  mask.flags.writeable = False
+  return mask
+
+class FrameFeatures():
+  '''
+  Derived images of a frame.
+
+  Every view is computed on first access and memoized,
+  so detectors sharing a frame never compute the same view twice.
+  '''
+  __slots__ = ('frame', 'previous', 'memo')
+
+  def __init__(self, frame : np.ndarray, previous : 'FrameFeatures | None' = None):
+    self.frame = frame
+    self.previous = previous
+    self.memo = {}
+
+  def derive(self, key, compute):
+    '''
+    Obtains a memoized view, computes it if not yet available.
+    '''
+    if key not in self.memo:
+      self.memo[key] = compute()
+    return self.memo[key]
+
+  def seed(self, key, value):
+    '''
+    Provides a precomputed view.
+    '''
+    self.memo[key] = value
+
+  @property
+  def shape(self) -> tuple[int, ...]:
+    return self.frame.shape
+
+  @property
+  def color(self) -> np.ndarray:
+    return self.derive('color', lambda: color_frame(self.frame))
+
+  def gray(self, code : int = cv.COLOR_BGR2GRAY) -> np.ndarray:
+    return self.derive(('gray', code), lambda: gray_frame(self.frame, code))
+
+  @property
+  def channels(self) -> tuple[np.ndarray, ...]:
+    return self.derive('channels', lambda: cv.split(self.color))
+
+  def downscaled(self, width : int, height : int) -> np.ndarray:
+    return self.derive(
+      ('downscaled', width, height),
+      lambda: cv.resize(self.gray(), (width, height), interpolation=cv.INTER_AREA),
+    )
+
+  def pyramid(self, level : int) -> 'FrameFeatures':
+    '''
+    Obtains features of the frame downscaled by half on each level.
+    '''
+    def compute():
+      height, width = self.frame.shape[:2]
+      size = (max(1, round(width / 2 ** level)), max(1, round(height / 2 ** level)))
+      return FrameFeatures(cv.resize(np.asarray(self.frame), size, interpolation=cv.INTER_AREA))
+    return self.derive(('pyramid', level), compute)
+
+  def region(self, region : tuple[slice, slice]) -> 'FrameFeatures':
+    '''
+    Obtains features of a frame region, given as pixel slices of (x, y).
+    '''
+    key = ('region', (region[0].start, region[0].stop), (region[1].start, region[1].stop))
+    return self.derive(key, lambda: FrameFeatures(self.frame[region[1], region[0]]))
+
+  def region_color(self, region : tuple[slice, slice]) -> 'FrameFeatures':
+    '''
+    Obtains color features of a frame region, converting luma frames first.
+    '''
+    key = ('region_color', (region[0].start, region[0].stop), (region[1].start, region[1].stop))
+    return self.derive(key, lambda: FrameFeatures(self.color[region[1], region[0]]))
+
+  @property
+  def difference(self) -> np.ndarray | None:
+    '''
+    Grayscale absolute difference to previous frame.
+    '''
+    if self.previous is None:
+      return None
+    return self.derive(
+      'difference',
+      lambda: gray_frame(cv.absdiff(self.frame, self.previous.frame), cv.COLOR_BGR2GRAY),
+    )
+
+  @property
+  def similarity(self) -> float:
+    '''
+    Similarity score against previous frame, see `utils.calculate_similarity`.
+    '''
+    def compute():
+      if self.previous is None:
+        return 100.0
+      score = cv.calcHist([self.difference], [0], None, [4], [0, 256])
+      score = 100 * score / score.sum()
+      return float(np.ravel(score)[0])
+    return self.derive('similarity', compute)
+
+  @property
+  def identical(self) -> bool:
+    '''
+    Checks whether the frame is exactly the previous frame.
+    '''
+    def compute():
+      if self.previous is None:
+        return True
+      return bool(np.all(self.frame == self.previous.frame))
+    return self.derive('identical', compute)
+
+  def rectangle_mask(self, offset : int) -> np.ndarray:
+    return rectangle_mask(self.frame.shape[:2], offset)
+
+  def darkness(self, offset : int = 80) -> tuple[bool, bool]:
+    '''
+    Darkness of the frame outside an inset rectangle, see `utils.measure_darkness`.
+    '''
+    from .utils import measure_darkness
+    return self.derive(('darkness', offset), lambda: measure_darkness(self.frame, self.rectangle_mask(offset)))
+
+  def detach_previous(self):
+    '''
+    Drops reference to previous frame, keeping computed views.
+    '''
+    self.previous = None
+
+__all__ = (
+  'LumaFrame', 'FrameFeatures',
+  'normalize_frame', 'normalized_width',
+  'gray_frame', 'color_frame',
+)
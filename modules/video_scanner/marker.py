@@ -9,13 +9,22 @@ import numpy as np
 import cv2 as cv
 
 from . import utils
+from . import matching
+from . import cascade as marker_cascade
+from .frame import FrameFeatures
 from modules import debug_flags
 
 log = logging.getLogger(__name__)
 MarkerName = typing.NewType('MarkerName', str)
 
 MARKER_FOLDER = os.path.join('assets', 'detection')
+# Frame height the marker images are cut from.
+MARKER_REFERENCE_HEIGHT = 1080
 DETECTION_AUTO_THRESHOLD = object()
+# Pixels searched around the last position of a tracked marker.
+TRACKING_MARGIN = 8
+# Matching engines, split matches every color channel separately and is the fastest on 1080p frames.
+MATCH_ENGINES = ('split', 'fused', 'fft')
 
 @dataclass(slots=True)
 class Marker():
@@ -29,6 +38,21 @@ class Marker():
   alpha_channel : np.ndarray = field(init=False, repr=False)
   color_channel : np.ndarray = field(init=False, repr=False)
 
+  # templates prepared for matching
+  gray_channel : np.ndarray = field(init=False, repr=False)
+  luma_channel : np.ndarray = field(init=False, repr=False)
+  color_channels : tuple[np.ndarray, ...] = field(init=False, repr=False)
+  color_template : matching.ChannelTemplate = field(init=False, repr=False)
+  gray_template : matching.ChannelTemplate = field(init=False, repr=False)
+  luma_template : matching.ChannelTemplate = field(init=False, repr=False)
+  profile : marker_cascade.MarkerProfile = field(init=False, repr=False)
+
+  # scaled markers keep their original marker for detection thresholds
+  scale : float = 1.0
+  source : typing.Optional['Marker'] = field(default=None, repr=False)
+  # downscaled markers by pyramid level
+  pyramid : dict[int, 'Marker'] = field(init=False, repr=False, default_factory=dict)
+
   def split_alpha_channel(self):
     marker_channels = cv.split(self.data)
     self.alpha_channel = None
@@ -51,11 +75,48 @@ class Marker():
     else:
       self.channel_count, self.width, self.height = 1, *self.color_channel.shape[::-1]
 
+  def prepare_templates(self):
+    self.gray_channel = cv.cvtColor(self.color_channel, cv.COLOR_RGB2GRAY)
+    self.luma_channel = cv.cvtColor(self.color_channel, cv.COLOR_BGR2GRAY)
+    self.color_channels = tuple(cv.split(self.color_channel))
+    self.color_template = matching.prepare_channel_template(self.color_channel, self.alpha_channel)
+    self.gray_template = matching.prepare_channel_template(self.gray_channel, self.alpha_channel)
+    self.luma_template = matching.prepare_channel_template(self.luma_channel, self.alpha_channel)
+    self.profile = marker_cascade.profile_marker(self.color_channel, self.alpha_channel)
+
+  def rescale(self, scale : float) -> 'Marker':
+    '''
+    Creates a copy of the marker resized by given scale, relative to the original marker.
+    '''
+    source = self.source or self
+    height, width = source.data.shape[:2]
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    data = cv.resize(source.data, size, interpolation=cv.INTER_AREA if scale < 1 else cv.INTER_LINEAR)
+    if data.ndim > 2 and data.shape[2] > 3:
+      # keep alpha as a binary mask
+      data[..., 3] = np.where(data[..., 3] >= 128, 255, 0)
+
+    marker = Marker(self.name, data, scale=scale, source=source)
+    marker.split_alpha_channel()
+    marker.analyze_dimensions()
+    marker.prepare_templates()
+    return marker
+
+  def pyramid_level(self, level : int) -> 'Marker':
+    '''
+    Obtains the marker downscaled for given pyramid level, memoized.
+    '''
+    if level not in self.pyramid:
+      self.pyramid[level] = self.rescale(self.scale / 2 ** level)
+    return self.pyramid[level]
+
 @dataclass(slots=True)
 class MarkerResult():
   marker : Marker
   ok : bool
   coords : np.ndarray = field(init=False, default=None, repr=False)
+  # position of the searched region, coords are relative to it
+  origin : tuple[int, int] = field(init=False, default=(0, 0), repr=False)
 
   def __bool__(self) -> bool:
     return self.ok
@@ -72,45 +133,54 @@ def load_markers(root_dir = MARKER_FOLDER) -> dict[MarkerName, Marker]:
     marker = Marker(name, img)
     marker.split_alpha_channel()
     marker.analyze_dimensions()
+    marker.prepare_templates()
 
     image_map[name] = marker
 
   return image_map
 
-def detect_frame_with_marker(
-  frame, marker : Marker, *,
+def match_marker(
+  region : FrameFeatures, marker : Marker, *,
   single_color_mode : bool = False,
   template_mode : int = cv.TM_CCOEFF_NORMED,
-  detection_threshold : float | object = DETECTION_AUTO_THRESHOLD,
-  detection_region : tuple[slice, slice] = None,
-) -> MarkerResult:
-  '''
-  Marker detection on an image.
+  engine : str = 'split',
+) -> np.ndarray:
   '''
-  if isinstance(detection_region, tuple):
-    detection_region = utils.slice_to_pixels(frame, detection_region)
+  Computes score map of a marker on a frame region.
 
-    frame = frame[
-      detection_region[1].start:detection_region[1].stop,
-      detection_region[0].start:detection_region[0].stop,
-    ]
-  else:
-    detection_region = (slice(0, None), slice(0, None))
-
-  if detection_threshold is DETECTION_AUTO_THRESHOLD:
-    detection_threshold = utils.calculate_detection_threshold(frame, marker)
+  Fused engine matches every channel at once, with finite scores for masked markers,
+  see `matching.fused_match`. FFT engine shares the region transform between markers,
+  see `matching.fft_match`. Split engine matches every color channel separately.
+  '''
+  frame = region.frame
+  if engine in ('fused', 'fft') and template_mode == cv.TM_CCOEFF_NORMED:
+    if not single_color_mode:
+      template = marker.color_template
+    elif frame.ndim == 2:
+      template = marker.luma_template
+    else:
+      region = region.derive(('gray_features', cv.COLOR_RGB2GRAY), lambda: FrameFeatures(region.gray(cv.COLOR_RGB2GRAY)))
+      template = marker.gray_template
 
-  if single_color_mode:
+    if engine == 'fft':
+      result = matching.fft_match(region, template)
+    elif single_color_mode and template.mask is None:
+      # unmasked grayscale is fast enough as is
+      result = cv.matchTemplate(region.frame, marker.luma_channel if frame.ndim == 2 else marker.gray_channel, template_mode)
+    else:
+      result = matching.fused_match(region, template)
+  elif single_color_mode and frame.ndim == 2:
+    # luma frame, marker converted the same way the decoder does
+    result = cv.matchTemplate(frame, marker.luma_channel, template_mode, mask=marker.alpha_channel)
+  elif single_color_mode:
     # single color focuses on grayscale
-    gray_frame, gray_marker = tuple(cv.cvtColor(img, cv.COLOR_RGB2GRAY) for img in (frame, marker.color_channel))
-    result = cv.matchTemplate(gray_frame, gray_marker, template_mode, mask=marker.alpha_channel)
+    result = cv.matchTemplate(region.gray(cv.COLOR_RGB2GRAY), marker.gray_channel, template_mode, mask=marker.alpha_channel)
   else:
     # all color averages the result from every colors
     # breaks upon invalid value found
     results = []
-    split_images = [cv.split(img) for img in (frame, marker.color_channel)]
 
-    for channel_frame, channel_marker in zip(*split_images):
+    for channel_frame, channel_marker in zip(region.channels, marker.color_channels):
       channel_result = cv.matchTemplate(channel_frame, channel_marker, template_mode, mask=marker.alpha_channel)
       results.append(channel_result)
       if not np.all(np.isfinite(channel_result)):
@@ -118,7 +188,146 @@ def detect_frame_with_marker(
 
     result = functools.reduce(lambda x, y: x + y, results) / len(results)
 
-  condition = (result >= detection_threshold) & np.isfinite(result)
+  return result
+
+# Detection region of markers without a configured region.
+FULL_REGION = (slice(0, None), slice(0, None))
+
+@dataclass(slots=True, frozen=True)
+class MarkerPlan():
+  '''
+  Detection settings of a marker resolved for a frame resolution.
+  '''
+  marker : Marker
+  region : tuple[slice, slice]
+  single_color_mode : bool
+  template_mode : int
+  detection_threshold : float
+  pyramid_levels : int
+  # marker downscaled for the coarse pyramid level
+  coarse_marker : Marker | None = field(repr=False)
+  match_engine : str
+  # prefilter settings merged with defaults, color markers only
+  cascade : dict | None
+
+def compile_marker_plan(
+  marker : Marker, resolution : tuple[int, int], *,
+  single_color_mode : bool = False,
+  template_mode : int = cv.TM_CCOEFF_NORMED,
+  detection_threshold : float | object = DETECTION_AUTO_THRESHOLD,
+  detection_region : tuple[slice, slice] = None,
+  pyramid_levels : int | None = 0,
+  match_engine : str = 'split',
+  cascade : dict | None = None,
+) -> MarkerPlan:
+  '''
+  Resolves detection settings of a marker for given frame resolution, see `detect_frame_with_marker`.
+  '''
+  if isinstance(detection_region, tuple):
+    detection_region = utils.region_to_pixels(resolution, detection_region)
+  else:
+    detection_region = FULL_REGION
+
+  if detection_threshold is DETECTION_AUTO_THRESHOLD:
+    detection_threshold = utils.calculate_detection_threshold(None, marker.source or marker)
+
+  if match_engine == 'fft' or template_mode not in matching.NORMED_MODES:
+    levels = 0
+  elif isinstance(pyramid_levels, int):
+    levels = pyramid_levels
+  else:
+    levels = matching.pyramid_levels(marker.width, marker.height)
+
+  cascade = {**marker_cascade.DEFAULT_CASCADE, **cascade} if cascade is not None and not single_color_mode else None
+
+  return MarkerPlan(
+    marker, detection_region,
+    single_color_mode, template_mode, detection_threshold,
+    levels, marker.pyramid_level(levels) if levels > 0 else None,
+    match_engine, cascade,
+  )
+
+def score_marker_plan(region : FrameFeatures, plan : MarkerPlan, single_color_mode : bool) -> np.ndarray:
+  def match(region, marker):
+    return match_marker(region, marker, single_color_mode=single_color_mode, template_mode=plan.template_mode, engine=plan.match_engine)
+
+  if plan.pyramid_levels > 0:
+    return matching.pyramid_match(region, plan.marker, plan.coarse_marker, plan.pyramid_levels, plan.detection_threshold, match)
+  return match(region, plan.marker)
+
+def batchable_marker_plan(plan : MarkerPlan) -> bool:
+  '''
+  Checks whether a marker plan is matched by a single plain `cv.matchTemplate` call.
+  '''
+  return plan.single_color_mode and plan.pyramid_levels == 0 and plan.match_engine != 'fft' and \
+    plan.cascade is None and plan.marker.alpha_channel is None
+
+def batch_scores_key(plan : MarkerPlan) -> tuple:
+  return ('batch_scores', plan.marker.name, plan.marker.scale, plan.template_mode)
+
+def batch_marker_plan(features_list : list[FrameFeatures], plan : MarkerPlan) -> bool:
+  '''
+  Matches a marker on the search region of several frames with one `cv.matchTemplate` call.
+
+  Regions are stacked vertically, windows spanning two regions are dropped,
+  and the scores of every region are provided to its frame features.
+  '''
+  marker = plan.marker
+  regions = [features.region(plan.region) for features in features_list]
+  shape = regions[0].shape[:2]
+  if shape[0] < marker.height or shape[1] < marker.width or any(region.shape[:2] != shape for region in regions):
+    return False
+
+  # luma frame, marker converted the same way the decoder does
+  luma = regions[0].frame.ndim == 2
+  images = [np.asarray(region.frame) if luma else region.gray(cv.COLOR_RGB2GRAY) for region in regions]
+  scores = cv.matchTemplate(np.concatenate(images), marker.luma_channel if luma else marker.gray_channel, plan.template_mode)
+
+  height = shape[0]
+  key = batch_scores_key(plan)
+  for i, region in enumerate(regions):
+    region.seed(key, scores[i * height:i * height + height - marker.height + 1])
+  return True
+
+def batched_scores(features : FrameFeatures, plan : MarkerPlan) -> np.ndarray | None:
+  '''
+  Obtains scores of the plan search region provided by `batch_marker_plan`, if any.
+  '''
+  return features.region(plan.region).memo.get(batch_scores_key(plan))
+
+def execute_marker_plan(
+  features : FrameFeatures, plan : MarkerPlan, detection_region : tuple[slice, slice] | None = None,
+  cascade_stats : marker_cascade.CascadeStats | None = None,
+) -> MarkerResult:
+  '''
+  Marker detection on a frame following a compiled plan.
+
+  Search region of the plan is replaced by given pixel region, if any.
+  Prefilter stage outcomes are counted on given cascade statistics.
+  '''
+  marker = plan.marker
+  if detection_region is None:
+    detection_region = plan.region
+
+  # color markers require color frame, converts luma frame if given
+  region = features.region(detection_region) if plan.single_color_mode else features.region_color(detection_region)
+
+  cascade = plan.cascade
+  if cascade is not None:
+    if marker_cascade.prefilter(region, marker, cascade, cascade_stats) is not None:
+      return MarkerResult(marker, False)
+    if cascade['gray_margin'] is not None and plan.template_mode in matching.NORMED_MODES:
+      rejected = not np.any(score_marker_plan(region, plan, True) >= plan.detection_threshold - cascade['gray_margin'])
+      if cascade_stats is not None:
+        cascade_stats.record(marker.name, 'gray', rejected)
+      if rejected:
+        return MarkerResult(marker, False)
+
+  result = region.memo.get(batch_scores_key(plan)) if plan.single_color_mode else None
+  if result is None:
+    result = score_marker_plan(region, plan, plan.single_color_mode)
+
+  condition = (result >= plan.detection_threshold) & np.isfinite(result)
   threshold_table = result[condition]
   coord_data = np.where(condition)
   coords = list(zip(*coord_data[::-1]))
@@ -135,12 +344,65 @@ def detect_frame_with_marker(
       log.debug(
         'found marker %s at threshold %7.3f. %7.3f~%7.3f',
         marker.name,
-        detection_threshold * 100,
+        plan.detection_threshold * 100,
         threshold_table.min() * 100, threshold_table.max() * 100,
       )
     marker_result.coords = coords
+    marker_result.origin = (detection_region[0].start or 0, detection_region[1].start or 0)
   else:
     pass
   return marker_result
 
+def detect_frame_with_marker(
+  frame, marker : Marker, *,
+  features : FrameFeatures | None = None,
+  **settings,
+) -> MarkerResult:
+  '''
+  Marker detection on an image.
+
+  Derived images are taken from given frame features when available.
+  Markers are matched coarse-to-fine with given pyramid levels, see `matching.pyramid_match`,
+  levels of None are determined from marker size, FFT engine matches the whole region instead.
+  Pyramid matching may miss hits scoring low on the coarse level, so it is off unless requested.
+
+  Color markers with cascade settings go through cheap rejection stages
+  and a grayscale match first, see `cascade.DEFAULT_CASCADE`.
+
+  Settings are resolved on every call, see `compile_marker_plan`
+  to resolve them once for frames of the same resolution.
+  '''
+  if features is None:
+    features = FrameFeatures(frame)
+
+  return execute_marker_plan(features, compile_marker_plan(marker, features.shape[1::-1], **settings))
+
+def tracking_region(result : MarkerResult, resolution : tuple[int, int], margin : int = TRACKING_MARGIN) -> tuple[slice, slice]:
+  '''
+  Obtains search region around the hits of a marker result, as pixel slices of (x, y).
+  '''
+  origin_x, origin_y = result.origin
+  xs, ys = [x for x, y in result.coords], [y for x, y in result.coords]
+  frame_width, frame_height = resolution
+  return (
+    slice(max(0, origin_x + int(min(xs)) - margin), min(frame_width, origin_x + int(max(xs)) + result.marker.width + margin)),
+    slice(max(0, origin_y + int(min(ys)) - margin), min(frame_height, origin_y + int(max(ys)) + result.marker.height + margin)),
+  )
+
+def marker_scale(frame_height : int) -> float:
+  '''
+  Marker scale for given frame height, rounded to share compiled markers.
+  '''
+  return round(frame_height / MARKER_REFERENCE_HEIGHT, 3)
+
+@functools.cache
+def scaled_markers(scale : float) -> dict[MarkerName, Marker]:
+  '''
+  Detection markers compiled for given scale.
+  '''
+  if scale == 1.0:
+    return Markers
+  log.debug('Compiling detection markers at scale %.3f.', scale)
+  return {name: marker.rescale(scale) for name, marker in Markers.items()}
+
 Markers : dict[MarkerName, Marker] = load_markers()
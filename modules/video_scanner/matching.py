@@ -0,0 +1,315 @@
+import math
+import logging
+from dataclasses import dataclass, field
+
+import numpy as np
+import cv2 as cv
+
+from .frame import FrameFeatures
+
+try:
+  from scipy.fft import rfft2, irfft2, next_fast_len
+except ImportError:
+  from numpy.fft import rfft2, irfft2
+
+  def next_fast_len(size : int) -> int:
+    return cv.getOptimalDFTSize(size)
+
+log = logging.getLogger(__name__)
+
+# Template modes where higher score is better match, with -1 as the lowest score.
+NORMED_MODES = (cv.TM_CCOEFF_NORMED, cv.TM_CCORR_NORMED)
+
+# Pyramid matching constants
+# Smallest template side (in pixels) to match on a pyramid.
+PYRAMID_MIN_TEMPLATE_SIZE = 96
+# Smallest template side (in pixels) on the coarsest level.
+PYRAMID_MIN_LEVEL_SIZE = 24
+PYRAMID_MAX_LEVELS = 2
+# Coarse score below detection threshold still considered as candidate.
+PYRAMID_CANDIDATE_MARGIN = 0.15
+# Candidate areas verified at full resolution, full frame is matched beyond this.
+PYRAMID_MAX_CANDIDATES = 16
+
+# Masks made of up to this many rectangles are summed through integral images.
+MASK_MAX_RECTANGLES = 24
+
+@dataclass(slots=True, frozen=True)
+class ChannelTemplate():
+  '''
+  Per-channel data of a marker, prepared for fused matching.
+
+  Each channel is centered on its masked mean and masked,
+  so correlating it with a frame window yields the numerator of TM_CCOEFF.
+  '''
+  centered : tuple[np.ndarray, ...] = field(repr=False)
+  norms : np.ndarray
+  mask : np.ndarray | None = field(repr=False)
+  mask_sum : float
+  width : int
+  height : int
+  # mask as (x, y, width, height) rectangles, if made of only a few
+  rectangles : tuple[tuple[int, int, int, int], ...] | None = field(repr=False)
+  # conjugate spectra by transform shape, see `fft_match`
+  spectra : dict = field(default_factory=dict, repr=False, compare=False)
+
+def prepare_channel_template(image : np.ndarray, alpha : np.ndarray | None) -> ChannelTemplate:
+  '''
+  Prepares template data of a color or grayscale image.
+
+  Alpha is taken as binary mask like `cv.matchTemplate` does.
+  '''
+  height, width = image.shape[:2]
+  mask = np.ones((height, width), dtype=np.float64) if alpha is None else (alpha > 0).astype(np.float64)
+  mask_sum = float(mask.sum())
+
+  centered = []
+  for channel in cv.split(image.astype(np.float64)):
+    centered.append(mask * (channel - (channel * mask).sum() / mask_sum))
+
+  return ChannelTemplate(
+    tuple(channel.astype(np.float32) for channel in centered),
+    np.array([math.sqrt((channel * channel).sum()) for channel in centered]),
+    None if alpha is None else mask,
+    mask_sum,
+    width, height,
+    mask_rectangles(mask),
+  )
+
+def mask_rectangles(mask : np.ndarray) -> tuple[tuple[int, int, int, int], ...] | None:
+  '''
+  Decomposes a binary mask into rectangles, merging rows with the same runs.
+
+  Returns None when it takes more than `MASK_MAX_RECTANGLES`.
+  '''
+  rectangles = []
+  open_runs = {}
+  previous_runs = ()
+  for y, row in enumerate(np.vstack([mask > 0, np.zeros((1, mask.shape[1]), dtype=bool)])):
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], row.astype(np.int8), [0]))))
+    runs = tuple(zip(edges[::2].tolist(), edges[1::2].tolist()))
+    if runs == previous_runs:
+      continue
+
+    for start, stop in previous_runs:
+      top = open_runs[(start, stop)]
+      rectangles.append((start, top, stop - start, y - top))
+    open_runs = {run: y for run in runs}
+    previous_runs = runs
+    if len(rectangles) > MASK_MAX_RECTANGLES:
+      return None
+
+  return tuple(rectangles)
+
+def integral_window_sums(integral : np.ndarray, rectangles, result_shape : tuple[int, int]) -> np.ndarray:
+  '''
+  Sums of every window over given rectangles of it, from an integral image.
+  '''
+  rows, columns = result_shape
+  sums = np.zeros((rows, columns, integral.shape[2]), dtype=np.float64)
+  for x, y, width, height in rectangles:
+    sums += (
+      integral[y + height:y + height + rows, x + width:x + width + columns] - integral[y:y + rows, x + width:x + width + columns] -
+      integral[y + height:y + height + rows, x:x + columns] + integral[y:y + rows, x:x + columns]
+    )
+  return sums
+
+def region_integrals(region : FrameFeatures) -> tuple[np.ndarray, np.ndarray]:
+  '''
+  Integral image of a region and its square, memoized.
+  '''
+  def compute():
+    integral, square_integral = cv.integral2(np.asarray(region.frame), sdepth=cv.CV_64F, sqdepth=cv.CV_64F)
+    return integral.reshape(*integral.shape[:2], -1), square_integral.reshape(*square_integral.shape[:2], -1)
+  return region.derive('integrals', compute)
+
+def fused_match(region : FrameFeatures, template : ChannelTemplate) -> np.ndarray:
+  '''
+  Computes TM_CCOEFF_NORMED score averaged over channels.
+
+  Window sums of every channel are taken in one pass through integral images,
+  only the numerator is correlated per channel.
+  Masks made of many rectangles are matched per channel with the mask instead,
+  filtering with such a mask costs more than matching.
+  Scores are finite, see `normalize_scores`.
+  '''
+  frame = np.asarray(region.frame)
+  result_shape = (frame.shape[0] - template.height + 1, frame.shape[1] - template.width + 1)
+  channels = region.derive(
+    'channels_float32',
+    lambda: tuple(channel.astype(np.float32) for channel in (region.channels if frame.ndim > 2 else (frame,))),
+  )
+
+  if template.rectangles is None:
+    return masked_match(channels, template)
+
+  numerator = np.dstack([
+    cv.matchTemplate(channel, centered, cv.TM_CCORR)
+    for channel, centered in zip(channels, template.centered)
+  ]).astype(np.float64)
+
+  integral, square_integral = region_integrals(region)
+  sums = integral_window_sums(integral, template.rectangles, result_shape)
+  square_sums = integral_window_sums(square_integral, template.rectangles, result_shape)
+
+  return normalize_scores(numerator, sums, square_sums, template)
+
+def masked_match(channels : tuple[np.ndarray, ...], template : ChannelTemplate) -> np.ndarray:
+  '''
+  Computes TM_CCOEFF_NORMED score of a masked template averaged over channels, matching each channel with the mask.
+
+  Windows `cv.matchTemplate` scores as non-finite or beyond [-1, 1] lack variance,
+  they are clamped as `normalize_scores` does.
+  '''
+  mask = template.mask.astype(np.float32)
+  scores = sum(
+    cv.matchTemplate(channel, centered, cv.TM_CCOEFF_NORMED, mask=mask)
+    for channel, centered in zip(channels, template.centered)
+  ) / len(template.centered)
+  with np.errstate(invalid='ignore'):
+    return np.where(np.abs(scores) <= 1, scores, np.where(np.abs(scores) < 1.125, np.sign(scores), 0)).astype(np.float32)
+
+def normalize_scores(numerator, sums, square_sums, template : ChannelTemplate) -> np.ndarray:
+  '''
+  Normalizes TM_CCOEFF numerators of every channel, then averages them.
+
+  Windows without enough variance are clamped the way `cv.matchTemplate` does
+  for unmasked templates, so masked templates get finite scores as well.
+  '''
+  if numerator.ndim == 2:
+    numerator, sums, square_sums = numerator[..., None], sums[..., None], square_sums[..., None]
+
+  variance = np.maximum(square_sums - sums * sums / template.mask_sum, 0)
+  denominator = np.sqrt(variance) * template.norms
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    magnitude = np.abs(numerator)
+    scores = np.where(
+      magnitude < denominator, numerator / denominator,
+      np.where(magnitude < denominator * 1.125, np.sign(numerator), 0),
+    )
+
+  return scores.mean(axis=2).astype(np.float32)
+
+class RegionSpectrum():
+  '''
+  Frequency domain data of a frame region, shared by every marker matched on it.
+
+  Holds transforms of the region and its square for masked window sums.
+  '''
+  __slots__ = ('shape', 'fft_shape', 'image', 'square')
+
+  def __init__(self, frame : np.ndarray):
+    image = np.asarray(frame).astype(np.float64)
+    if image.ndim == 2:
+      image = image[..., None]
+
+    self.shape = image.shape[:2]
+    self.fft_shape = tuple(next_fast_len(size) for size in self.shape)
+    self.image = rfft2(image, s=self.fft_shape, axes=(0, 1))
+    self.square = rfft2(image * image, s=self.fft_shape, axes=(0, 1))
+
+  def correlate(self, spectrum : np.ndarray, template_spectrum : np.ndarray, result_shape : tuple[int, int]) -> np.ndarray:
+    '''
+    Correlates transformed channels with a transformed template, valid windows only.
+    '''
+    if template_spectrum.ndim == 2:
+      template_spectrum = template_spectrum[..., None]
+    result = irfft2(spectrum * template_spectrum, s=self.fft_shape, axes=(0, 1))
+    return result[:result_shape[0], :result_shape[1]]
+
+
+def template_spectra(template : ChannelTemplate, fft_shape : tuple[int, int]) -> tuple[np.ndarray, np.ndarray | None]:
+  '''
+  Obtains conjugate spectra of centered channels and mask, memoized by transform shape.
+  '''
+  if fft_shape not in template.spectra:
+    centered = np.dstack(template.centered).astype(np.float64)
+    template.spectra[fft_shape] = (
+      np.conj(rfft2(centered, s=fft_shape, axes=(0, 1))),
+      None if template.rectangles is not None else np.conj(rfft2(template.mask, s=fft_shape)),
+    )
+  return template.spectra[fft_shape]
+
+def fft_match(region : FrameFeatures, template : ChannelTemplate) -> np.ndarray:
+  '''
+  Computes TM_CCOEFF_NORMED score averaged over channels through the frequency domain.
+
+  The region is transformed once and shared by every marker matched on it,
+  each marker only adds inverse transforms of its own.
+  Scores follow `fused_match`.
+  '''
+  spectrum = region.derive('spectrum', lambda: RegionSpectrum(region.frame))
+  result_shape = (spectrum.shape[0] - template.height + 1, spectrum.shape[1] - template.width + 1)
+  centered_spectrum, mask_spectrum = template_spectra(template, spectrum.fft_shape)
+
+  numerator = spectrum.correlate(spectrum.image, centered_spectrum, result_shape)
+  if template.rectangles is not None:
+    integral, square_integral = region_integrals(region)
+    sums = integral_window_sums(integral, template.rectangles, result_shape)
+    square_sums = integral_window_sums(square_integral, template.rectangles, result_shape)
+  else:
+    sums = spectrum.correlate(spectrum.image, mask_spectrum, result_shape)
+    square_sums = spectrum.correlate(spectrum.square, mask_spectrum, result_shape)
+
+  return normalize_scores(numerator, sums, square_sums, template)
+
+def pyramid_levels(width : int, height : int) -> int:
+  '''
+  Determines pyramid levels of a template, halving its size on each level.
+  '''
+  size = min(width, height)
+  if size < PYRAMID_MIN_TEMPLATE_SIZE:
+    return 0
+  return max(0, min(PYRAMID_MAX_LEVELS, int(math.log2(size / PYRAMID_MIN_LEVEL_SIZE))))
+
+def pyramid_match(
+  region : FrameFeatures, marker, coarse_marker, levels : int,
+  detection_threshold : float, match,
+) -> np.ndarray:
+  '''
+  Matches a marker on a downscaled frame first, then verifies candidates at full resolution.
+
+  `match(features, marker)` computes the score map of a marker on a frame.
+  Returns score map of the full resolution frame, areas without candidates
+  are filled with the lowest score. Falls back to full resolution matching
+  when the coarse score map is invalid or has too many candidates.
+  '''
+  factor = 2 ** levels
+  frame_height, frame_width = region.shape[:2]
+  result_shape = (frame_height - marker.height + 1, frame_width - marker.width + 1)
+  coarse_region = region.pyramid(levels)
+  if min(coarse_region.shape[:2]) < max(coarse_marker.width, coarse_marker.height) or \
+    min(result_shape) < 1:
+    return match(region, marker)
+
+  coarse_result = match(coarse_region, coarse_marker)
+  if not np.all(np.isfinite(coarse_result)):
+    return match(region, marker)
+
+  candidates = (coarse_result >= detection_threshold - PYRAMID_CANDIDATE_MARGIN).astype(np.uint8)
+  component_count, _, stats, _ = cv.connectedComponentsWithStats(candidates, connectivity=8)
+  if component_count - 1 > PYRAMID_MAX_CANDIDATES:
+    return match(region, marker)
+
+  result = np.full(result_shape, -1, dtype=np.float32)
+  margin = 2 * factor
+  for x, y, width, height, _ in stats[1:]:
+    x0, y0 = max(0, x * factor - margin), max(0, y * factor - margin)
+    x1 = min(result_shape[1], (x + width) * factor + margin)
+    y1 = min(result_shape[0], (y + height) * factor + margin)
+    if x1 <= x0 or y1 <= y0:
+      continue
+
+    window = FrameFeatures(region.frame[y0:y1 + marker.height - 1, x0:x1 + marker.width - 1])
+    result[y0:y1, x0:x1] = match(window, marker)
+
+  return result
+
+__all__ = (
+  'NORMED_MODES',
+  'ChannelTemplate', 'prepare_channel_template',
+  'fused_match', 'masked_match', 'normalize_scores',
+  'RegionSpectrum', 'fft_match',
+  'pyramid_levels', 'pyramid_match',
+)
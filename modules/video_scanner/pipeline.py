@@ -0,0 +1,344 @@
+import os
+import queue
+import logging
+import contextlib
+import multiprocessing
+from multiprocessing import shared_memory
+from dataclasses import dataclass
+
+import numpy as np
+
+from .state import VideoFrameData, VideoFrameEvent, detect_planned_marker
+from .marker import MarkerResult
+from .frame import LumaFrame, FrameFeatures
+from .task import Scanner, ScanState
+
+log = logging.getLogger(__name__)
+
+# Frame slots of the shared ring for each detector process.
+PIPELINE_SLOTS_PER_WORKER = 4
+# Seconds waited for results before checking pipeline processes.
+PIPELINE_POLL_TIMEOUT = 1.0
+# Scanner options used by the decoder process.
+DECODER_OPTIONS = (
+  'seek_option', 'frame_limit', 'frame_windows', 'prefetch',
+  'backend', 'decode_options', 'detection_height',
+)
+
+def attach_ring(name : str) -> shared_memory.SharedMemory:
+  '''
+  Attaches to the frame ring created by the decoder process, leaving cleanup to it.
+  '''
+  try:
+    return shared_memory.SharedMemory(name, track=False)
+  except TypeError:
+    # resource tracker would unlink the ring once any attached process exits
+    from multiprocessing import resource_tracker
+    ring = shared_memory.SharedMemory(name)
+    resource_tracker.unregister(ring._name, 'shared_memory')
+    return ring
+
+def decode_frames(video_file : str, options : dict, slot_count : int, worker_count : int, task_queue, result_queue, free_queue, retire_queue):
+  '''
+  Decoder process, writes frames not skipped into the ring and queues them for detection.
+
+  Frame similarity is measured here as only this process sees consecutive frames.
+  Markers retired by the scan so far are passed along, see `MarkerSchedule.retired`.
+  '''
+  ring = None
+  retired = frozenset()
+  try:
+    with Scanner(video_file, **options) as (scanner, video):
+      sequence = 0
+      while scanner.end_frame_count is None:
+        scanner.read_frame()
+        while scanner.pending_frames:
+          pending = scanner.pending_frames.popleft()
+          features = pending.features
+          similarity, identical = features.similarity, features.identical
+          if features.previous is not None:
+            features.previous.detach_previous()
+
+          frame = pending.frame
+          luma_height = None
+          if isinstance(frame, LumaFrame) and frame.planes is not None:
+            frame, luma_height = frame.planes, frame.shape[0]
+          frame = np.ascontiguousarray(frame)
+
+          if ring is None:
+            slot_size = frame.nbytes
+            ring = shared_memory.SharedMemory(create=True, size=slot_size * slot_count)
+            result_queue.put(('ring', ring.name))
+            for slot in range(slot_count):
+              free_queue.put(slot)
+          if frame.nbytes != slot_size:
+            raise ValueError(f'frame size changed from {slot_size} to {frame.nbytes} bytes')
+
+          slot = free_queue.get()
+          np.ndarray(frame.shape, frame.dtype, ring.buf, slot * slot_size)[:] = frame
+          with contextlib.suppress(queue.Empty):
+            while True:
+              retired = retire_queue.get_nowait()
+          task_queue.put((sequence, ring.name, slot, slot_size, frame.shape, luma_height, pending.time, similarity, identical, retired))
+          sequence += 1
+
+      result_queue.put(('end', sequence, scanner.end_frame_count))
+  except Exception as e:
+    log.error('Failed to decode %s.', video_file, exc_info=True)
+    result_queue.put(('error', 'decoder', repr(e)))
+  finally:
+    for _ in range(worker_count):
+      task_queue.put(None)
+    if ring is not None:
+      # waits until every detector released its slot
+      for _ in range(slot_count):
+        free_queue.get()
+      ring.close()
+      ring.unlink()
+
+def detect_frames(params : dict, task_queue, result_queue, free_queue):
+  '''
+  Detector process, matches required markers not yet retired on frames claimed from the ring.
+  '''
+  rings = {}
+  frame_data = VideoFrameData()
+  try:
+    while (task := task_queue.get()) is not None:
+      sequence, ring_name, slot, slot_size, shape, luma_height, time, similarity, identical, retired = task
+      if ring_name not in rings:
+        rings[ring_name] = attach_ring(ring_name)
+
+      frame = features = None
+      try:
+        frame = np.ndarray(shape, np.uint8, rings[ring_name].buf, slot * slot_size)
+        if luma_height is not None:
+          frame = LumaFrame(frame, luma_height)
+        features = FrameFeatures(frame)
+        resolution = features.shape[1::-1]
+        plan = VideoFrameEvent.detection_plan(frame_data, resolution, params)
+
+        marker_results = {}
+        for planned in plan.markers:
+          if planned.name in retired:
+            continue
+          result = detect_planned_marker(features, planned, None, None)
+          marker_results[planned.name] = (
+            result.ok,
+            [(int(x), int(y)) for x, y in result.coords] if result.ok else None,
+            result.origin,
+          )
+        darkness = features.darkness(80)
+      finally:
+        # frame views must be gone before the slot is reused
+        del frame, features
+        free_queue.put(slot)
+
+      result_queue.put(('frame', sequence, (time, resolution, similarity, identical, darkness, marker_results)))
+  except Exception as e:
+    log.error('Failed to detect frames.', exc_info=True)
+    result_queue.put(('error', 'detector', repr(e)))
+  finally:
+    for ring in rings.values():
+      ring.close()
+
+@dataclass(slots=True)
+class PipelineScanState(ScanState):
+  '''
+  Scan State object of a frame detected by a pipeline detector process.
+  '''
+  detected : tuple = None
+
+  def process(self):
+    '''
+    Scanning flow, marker detection already took place elsewhere.
+    '''
+    self.accept_marker_results()
+    self.frame_event.prepare_state_changes_in_frame(self.frame)
+    self.frame_data.update(self.frame_event.states)
+
+  def accept_marker_results(self):
+    '''
+    Restores detected marker results, dropping markers the scan would not search on this frame.
+    '''
+    frame_data = self.frame_data
+    time, resolution, marker_results = self.detected
+    plan = VideoFrameEvent.detection_plan(frame_data, resolution, frame_data.params)
+    schedule = frame_data.schedule
+    if schedule is not None:
+      schedule.observe(frame_data.states)
+    sampling = frame_data.sampling
+    if sampling is not None:
+      sampling.observe(self.features, time)
+
+    self.frame_event.marker_results = dict()
+    for planned in plan.markers:
+      name = planned.name
+      if name not in marker_results:
+        continue
+      if schedule is not None and not schedule.relevant(name):
+        continue
+      if sampling is not None and not sampling.due(name, planned.cadence, time):
+        continue
+
+      ok, coords, origin = marker_results[name]
+      result = MarkerResult(planned.detection.marker, ok)
+      if ok:
+        result.coords = coords
+        result.origin = origin
+      self.frame_event.marker_results[name] = result
+
+class PipelineScanner(Scanner):
+  '''
+  Scanner object running decoding and marker detection on separate processes.
+
+  One decoder process writes frames into a shared memory ring,
+  detector processes claim frames from it and return marker results only.
+  Results are reordered so states are updated in frame order.
+
+  Markers are always searched in their configured region,
+  tracking and learned regions are not applied.
+
+  Detector processes work ahead of the scan states, so they only skip markers
+  retired for good by the marker schedule. Markers waiting for their `after` states
+  and markers off their sampling cadence are still matched, then dropped here.
+  '''
+
+  def __init__(self, video_file, *, workers : int = 1, **options):
+    super().__init__(video_file, **options)
+    self.workers = max(1, workers)
+    self.decoder_options = {key: value for key, value in options.items() if key in DECODER_OPTIONS}
+    # detection happens on detector processes
+    self.marker_threads = 0
+    self.batch_frames = 0
+    self.learn_regions = False
+    self.processes = []
+
+  def __init_transient_variables__(self):
+    super().__init_transient_variables__()
+    self.received = {}
+    self.next_sequence = 0
+    self.sequence_total = None
+    self.ring_name = None
+    self.retired = frozenset()
+
+  def __enter__(self):
+    self.__init_transient_variables__()
+    context = multiprocessing.get_context()
+    self.task_queue, self.result_queue, self.free_queue = context.Queue(), context.Queue(), context.Queue()
+    self.retire_queue = context.Queue()
+    params = {key: self.params[key] for key in ('scale_markers', 'match_engine', 'pyramid_match')}
+    self.processes = [
+      context.Process(
+        target=decode_frames, name='decoder',
+        args=(
+          self.video_file, self.decoder_options, self.workers * PIPELINE_SLOTS_PER_WORKER, self.workers,
+          self.task_queue, self.result_queue, self.free_queue, self.retire_queue,
+        ),
+      ),
+      *(
+        context.Process(target=detect_frames, name=f'detector-{i}', args=(params, self.task_queue, self.result_queue, self.free_queue))
+        for i in range(self.workers)
+      ),
+    ]
+    for process in self.processes:
+      process.start()
+
+    self.prepare_frame_data()
+    return self, None
+
+  def receive(self):
+    '''
+    Takes a message from pipeline processes.
+    '''
+    try:
+      message = self.result_queue.get(timeout=PIPELINE_POLL_TIMEOUT)
+    except queue.Empty:
+      if any(process.exitcode not in (None, 0) for process in self.processes):
+        raise RuntimeError('pipeline process exited unexpectedly') from None
+      return
+
+    kind, *payload = message
+    if kind == 'frame':
+      sequence, detected = payload
+      self.received[sequence] = detected
+    elif kind == 'ring':
+      self.ring_name, = payload
+    elif kind == 'end':
+      self.sequence_total, self.end_frame_count = payload
+    elif kind == 'error':
+      source, error = payload
+      raise RuntimeError(f'pipeline {source} failed: {error}')
+
+  def retire_markers(self):
+    '''
+    Tells the decoder process about markers retired since the last frame.
+    '''
+    schedule = self.frame_data.schedule
+    if schedule is None:
+      return
+    schedule.observe(self.frame_data.states)
+    retired = schedule.retired()
+    if retired != self.retired:
+      self.retired = retired
+      self.retire_queue.put(retired)
+
+  def __next__(self):
+    self.retire_markers()
+    while self.next_sequence not in self.received:
+      if self.sequence_total is not None and self.next_sequence >= self.sequence_total:
+        self.frame_count = self.end_frame_count
+        raise StopIteration()
+      self.receive()
+
+    time, resolution, similarity, identical, darkness, marker_results = self.received.pop(self.next_sequence)
+    self.next_sequence += 1
+
+    # views detectors take from the frame, computed on pipeline processes
+    features = FrameFeatures(None)
+    features.seed('similarity', similarity)
+    features.seed('identical', identical)
+    features.seed(('darkness', 80), darkness)
+
+    self.frame_count, self.frame_rate = time
+    self.iter_count += 1
+    self.frame_data.params = self.params
+
+    return PipelineScanState(None, VideoFrameEvent(self.frame_data, features), (time, resolution, marker_results))
+
+  def __exit__(self, *exc):
+    self.finish_scan()
+    for process in self.processes:
+      if exc[0] is not None:
+        process.terminate()
+      process.join()
+
+    if self.ring_name is not None:
+      # decoder may have been stopped before releasing the ring
+      try:
+        ring = shared_memory.SharedMemory(self.ring_name)
+      except FileNotFoundError:
+        pass
+      else:
+        ring.close()
+        ring.unlink()
+
+    self.frame_count = -1
+    return False
+
+def scan_video_pipeline(video_file : str, *, workers : int, **opts):
+  '''
+  Scans a video file with one decoder process and given detector processes.
+  '''
+  workers = max(1, min(workers, (os.cpu_count() or 2) - 1))
+  log.info('Scanning %s on %d detector process(es).', video_file, workers)
+
+  with PipelineScanner(video_file, workers = workers, **opts) as (scanner, video):
+    for scan_state in scanner:
+      scan_state.process()
+
+  return scanner.state_logs
+
+__all__ = (
+  'PipelineScanner',
+  'scan_video_pipeline',
+)
@@ -0,0 +1,234 @@
+import os
+import glob
+import json
+import time
+import hashlib
+import logging
+import threading
+import contextlib
+
+log = logging.getLogger(__name__)
+
+ROI_FOLDER = os.path.join('_cache', 'roi')
+ROI_VERSION = 1
+# Hits required before a learned region is searched instead of the full frame.
+ROI_MIN_HITS = 10
+# Pixels searched around a learned region.
+ROI_MARGIN = 16
+# Seconds without a hit in the learned region before the full frame is searched once.
+ROI_WIDEN_SPAN = 30
+# Seconds waited for another scan storing the same profile.
+ROI_LOCK_TIMEOUT = 10
+# Seconds after which a lock is regarded as left behind by a stopped scan.
+ROI_LOCK_STALE = 60
+ROI_LOCK_POLL = 0.05
+
+@contextlib.contextmanager
+def profile_lock(path : str):
+  '''
+  Holds an exclusive lock file next to a stored profile, across processes and threads.
+  '''
+  lock_path = path + '.lock'
+  deadline = time.monotonic() + ROI_LOCK_TIMEOUT
+  while True:
+    try:
+      fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+      break
+    except FileExistsError:
+      try:
+        if time.time() - os.path.getmtime(lock_path) > ROI_LOCK_STALE:
+          os.remove(lock_path)
+          continue
+      except FileNotFoundError:
+        continue
+      if time.monotonic() > deadline:
+        raise TimeoutError(f'timed out waiting for {lock_path}') from None
+      time.sleep(ROI_LOCK_POLL)
+
+  try:
+    yield
+  finally:
+    os.close(fd)
+    os.remove(lock_path)
+
+def fingerprint_profiles() -> str:
+  '''
+  Hash of regions searched by scans, scan results depend on them when regions are learned.
+
+  Only covers regions with enough hits to be searched,
+  hit counts change on every scan while the searched regions settle.
+  '''
+  digest = hashlib.blake2b(str(ROI_VERSION).encode(), digest_size=20)
+  for fn in sorted(glob.iglob('*.json', root_dir = ROI_FOLDER)):
+    try:
+      with open(os.path.join(ROI_FOLDER, fn)) as f:
+        payload = json.load(f)
+    except (OSError, ValueError):
+      continue
+    if payload.get('version') != ROI_VERSION:
+      continue
+
+    searched = sorted(
+      (name, region[:4])
+      for name, region in payload['markers'].items()
+      if region[4] >= ROI_MIN_HITS
+    )
+    digest.update(fn.encode())
+    digest.update(repr(searched).encode())
+  return digest.hexdigest()
+
+class RoiProfile():
+  '''
+  Learned detection regions of markers for a frame resolution.
+
+  Regions are kept as bounding box of marker hit positions (top-left),
+  along with the number of hits, persisted per resolution.
+  '''
+
+  def __init__(self, resolution : tuple[int, int], regions : dict[str, list[int]] | None = None):
+    self.resolution = resolution
+    self.regions = regions or {}
+    self.changes = {}
+
+  @staticmethod
+  def path(resolution : tuple[int, int]) -> str:
+    return os.path.join(ROI_FOLDER, '{0}x{1}.json'.format(*resolution))
+
+  @classmethod
+  def load(cls, resolution : tuple[int, int]) -> 'RoiProfile':
+    return cls(resolution, cls.read(resolution))
+
+  @classmethod
+  def read(cls, resolution : tuple[int, int]) -> dict[str, list[int]]:
+    try:
+      with open(cls.path(resolution)) as f:
+        payload = json.load(f)
+    except FileNotFoundError:
+      return {}
+    except (OSError, ValueError):
+      log.warning('Failed to load detection regions of %dx%d.', *resolution, exc_info=True)
+      return {}
+
+    if payload.get('version') != ROI_VERSION:
+      return {}
+    return payload['markers']
+
+  def store(self):
+    '''
+    Merges learned regions into the stored profile.
+
+    Regions learned by other scans in the meantime are kept,
+    the profile is locked from reading until it is replaced.
+    '''
+    if not self.changes:
+      return
+
+    try:
+      path = self.path(self.resolution)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      # scans on other processes or threads may store the same profile
+      with profile_lock(path):
+        regions = self.read(self.resolution)
+        for name, change in self.changes.items():
+          regions[name] = merge_region(regions.get(name), change)
+
+        temp_path = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+        with open(temp_path, 'w') as f:
+          json.dump({'version': ROI_VERSION, 'markers': regions}, f)
+        os.replace(temp_path, path)
+    except OSError:
+      log.warning('Failed to store detection regions of %dx%d.', *self.resolution, exc_info=True)
+      return
+
+    self.regions = regions
+    self.changes = {}
+
+  def learn(self, name : str, coords : list[tuple[int, int]]):
+    '''
+    Records absolute hit positions of a marker.
+    '''
+    xs, ys = [x for x, y in coords], [y for x, y in coords]
+    hit = [int(min(xs)), int(min(ys)), int(max(xs)), int(max(ys)), 1]
+    self.changes[name] = merge_region(self.changes.get(name), hit)
+    self.regions[name] = merge_region(self.regions.get(name), hit)
+
+  def region(self, name : str, width : int, height : int, margin : int = ROI_MARGIN) -> tuple[slice, slice] | None:
+    '''
+    Obtains learned search region of a marker as pixel slices of (x, y).
+    '''
+    learned = self.regions.get(name)
+    if learned is None or learned[4] < ROI_MIN_HITS:
+      return None
+
+    x0, y0, x1, y1, _ = learned
+    frame_width, frame_height = self.resolution
+    return (
+      slice(max(0, x0 - margin), min(frame_width, x1 + width + margin)),
+      slice(max(0, y0 - margin), min(frame_height, y1 + height + margin)),
+    )
+
+def merge_region(region : list[int] | None, other : list[int]) -> list[int]:
+  if region is None:
+    return list(other)
+  return [
+    min(region[0], other[0]), min(region[1], other[1]),
+    max(region[2], other[2]), max(region[3], other[3]),
+    region[4] + other[4],
+  ]
+
+class RoiTracker():
+  '''
+  Chooses search regions of markers during a scan.
+
+  Markers are searched in their learned region, once a marker is not found there
+  for the widen span, the full frame is searched once and the span starts over.
+  A hit on the full frame extends the learned region.
+
+  A marker shown outside its learned region between two full frame searches
+  is missed, the widen span bounds how long.
+  '''
+
+  def __init__(self, widen_span : float = ROI_WIDEN_SPAN):
+    self.widen_span = widen_span
+    self.profiles : dict[tuple[int, int], RoiProfile] = {}
+    # frame of the last hit or full frame search of each marker
+    self.span_start : dict[str, int] = {}
+
+  def profile(self, resolution : tuple[int, int]) -> RoiProfile:
+    if resolution not in self.profiles:
+      self.profiles[resolution] = RoiProfile.load(resolution)
+    return self.profiles[resolution]
+
+  def search_region(self, name : str, marker, resolution : tuple[int, int], time : tuple[int, float]) -> tuple[slice, slice] | None:
+    '''
+    Obtains search region of a marker for current frame, None for full frame.
+    '''
+    region = self.profile(resolution).region(name, marker.width, marker.height)
+    if region is None:
+      return None
+
+    n, fps = time
+    span_start = self.span_start.setdefault(name, n)
+    if n - span_start >= self.widen_span * fps:
+      self.span_start[name] = n
+      return None
+    return region
+
+  def observe(self, name : str, result, resolution : tuple[int, int], time : tuple[int, float]):
+    '''
+    Learns from a marker result.
+    '''
+    if not result.ok:
+      return
+    origin_x, origin_y = result.origin
+    self.profile(resolution).learn(name, [(x + origin_x, y + origin_y) for x, y in result.coords])
+    self.span_start[name] = time[0]
+
+  def store(self):
+    for profile in self.profiles.values():
+      profile.store()
+
+__all__ = (
+  'RoiProfile', 'RoiTracker',
+  'fingerprint_profiles',
+)
@@ -1,7 +1,8 @@
 import enum
 import typing
 import logging
-from dataclasses import dataclass
+import concurrent.futures
+from dataclasses import dataclass, field
 
 import numpy as np
 import cv2 as cv
@@ -11,8 +12,18 @@ from .marker import (
   MarkerResult,
   MarkerName,
   Markers,
-  detect_frame_with_marker,
+  MarkerPlan,
+  compile_marker_plan,
+  execute_marker_plan,
+  batchable_marker_plan,
+  batch_marker_plan,
+  batched_scores,
+  tracking_region,
+  marker_scale,
+  scaled_markers,
 )
+from .frame import FrameFeatures
+from .cascade import CascadeStats
 
 log = logging.getLogger(__name__)
 
@@ -80,11 +91,207 @@ class VideoStateDict():
       changed_map = dict((state, value) for state, value in state_pair if state not in self.states or value != self.states.get(state, None))
       self.states.update(changed_map)
 
+@dataclass(slots=True, frozen=True)
+class MarkerGate():
+  '''
+  Scan states gating the search of a marker.
+
+  Marker is searched once any of `after` states has been set,
+  and no longer searched once any of `until` states is set.
+  Setting any of `rearm` states afterwards searches the marker again.
+  '''
+  after : tuple[VideoState, ...] = ()
+  until : tuple[VideoState, ...] = ()
+  rearm : tuple[VideoState, ...] = ()
+
+@dataclass(slots=True)
+class MarkerSchedule():
+  '''
+  Decides which markers can still change scan states, from the states set so far.
+  '''
+  gates : dict[MarkerName, MarkerGate]
+  seen : set[VideoState] = field(default_factory=set)
+  # states set on the last observed frame
+  current : set[VideoState] = field(default_factory=set)
+  # markers stopped by their `until` states
+  suspended : set[MarkerName] = field(default_factory=set)
+
+  def observe(self, states : dict[VideoState, bool]):
+    current = set(state for state, value in states.items() if value)
+    raised = current - self.current
+    self.current = current
+    self.seen.update(current)
+    if not raised:
+      return
+    for name, gate in self.gates.items():
+      if name in self.suspended:
+        if not raised.isdisjoint(gate.rearm):
+          self.suspended.discard(name)
+      elif not raised.isdisjoint(gate.until):
+        self.suspended.add(name)
+
+  def relevant(self, marker_name : MarkerName) -> bool:
+    gate = self.gates.get(marker_name)
+    if gate is None:
+      return True
+    if gate.after and self.seen.isdisjoint(gate.after):
+      return False
+    return marker_name not in self.suspended
+
+  def retired(self) -> frozenset[MarkerName]:
+    '''
+    Markers no longer searched for the rest of the scan.
+
+    Suspended markers that can be rearmed are still matched.
+    '''
+    return frozenset(
+      name
+      for name in self.suspended
+      if not self.gates[name].rearm
+    )
+
+# Seconds everything is sampled every frame after a possible transition.
+CADENCE_ALERT_SPAN = 1.0
+# Frame similarity below this suggests a transition, see `FrameFeatures.similarity`.
+CADENCE_ALERT_SIMILARITY = 90.0
+
+@dataclass(slots=True, frozen=True)
+class Cadence():
+  '''
+  Sampling cadence of a detector or a marker.
+
+  Samples are at least given frames and milliseconds apart.
+  '''
+  frames : int = 1
+  ms : float = 0
+
+  def due(self, elapsed : int, fps : float) -> bool:
+    return elapsed >= self.frames and elapsed * 1000 >= self.ms * fps
+
+EVERY_FRAME = Cadence()
+
+@dataclass(slots=True)
+class SamplingSchedule():
+  '''
+  Decides whether detectors and markers are sampled on a frame, by their cadence.
+
+  Everything is sampled every frame for a while after a state change
+  or a large frame change, as a transition may be near.
+  '''
+  alert_span : float = CADENCE_ALERT_SPAN
+  alert_similarity : float = CADENCE_ALERT_SIMILARITY
+  last_sampled : dict[typing.Hashable, int] = field(default_factory=dict)
+  alert_until : int = -1
+
+  def alert(self, time : tuple[int, float]):
+    n, fps = time
+    self.alert_until = max(self.alert_until, n + int(self.alert_span * fps))
+
+  def observe(self, features : FrameFeatures, time : tuple[int, float]):
+    if features.similarity < self.alert_similarity:
+      self.alert(time)
+
+  def due(self, key : typing.Hashable, cadence : Cadence, time : tuple[int, float]) -> bool:
+    n, fps = time
+    last = self.last_sampled.get(key)
+    if last is not None and n > self.alert_until and not cadence.due(n - last, fps):
+      return False
+    self.last_sampled[key] = n
+    return True
+
+@dataclass(slots=True, frozen=True)
+class PlannedMarker():
+  name : MarkerName
+  detection : MarkerPlan
+  tracking : bool
+  cadence : Cadence
+  # learned regions are only searched for markers without a configured region
+  learned_region : bool
+
+@dataclass(slots=True, frozen=True)
+class DetectionPlan():
+  '''
+  Marker detection of a scan, compiled once the frame resolution is known.
+  '''
+  resolution : tuple[int, int]
+  markers : tuple[PlannedMarker, ...]
+
+def detect_planned_marker(
+  features : FrameFeatures, planned : PlannedMarker,
+  detection_region : tuple[slice, slice] | None, track : tuple[slice, slice] | None,
+  cascade_stats : CascadeStats | None = None,
+) -> MarkerResult:
+  '''
+  Detects a planned marker, around its track first if given.
+
+  Does not touch scan state, so markers of a frame can be detected concurrently.
+  '''
+  if track is not None and batched_scores(features, planned.detection) is None:
+    # tracked marker stays in place, searches the whole region again once lost
+    result = execute_marker_plan(features, planned.detection, track, cascade_stats)
+    if result.ok:
+      return result
+  return execute_marker_plan(features, planned.detection, detection_region, cascade_stats)
+
+Detector = typing.Callable[['VideoFrameEvent', np.ndarray], None]
+
+class DetectorRegistry():
+  '''
+  Ordered registry of state change events.
+
+  Detectors keeping state across frames are registered as factories,
+  every scan creates its own detectors so scans never share detector state.
+  '''
+
+  def __init__(self):
+    self.entries : list[tuple[bool, typing.Callable]] = []
+
+  def register(self, detector : Detector):
+    if (False, detector) not in self.entries:
+      self.entries.append((False, detector))
+
+  def register_factory(self, factory : typing.Callable[[], typing.Iterable[Detector]]):
+    if (True, factory) not in self.entries:
+      self.entries.append((True, factory))
+
+  def create(self) -> tuple[Detector, ...]:
+    return tuple(
+      detector
+      for is_factory, entry in self.entries
+      for detector in (entry() if is_factory else (entry,))
+    )
+
+detector_registry = DetectorRegistry()
+
+def required_markers(detectors : typing.Iterable[Detector]) -> frozenset | None:
+  '''
+  Markers required by given detectors, None when any marker may be required.
+  '''
+  if not all(hasattr(f, '__required_markers__') for f in detectors):
+    return None
+  return frozenset(marker for f in detectors for marker in f.__required_markers__)
+
 class VideoFrameData(VideoStateDict):
   def __init__(self):
     super().__init__(False)
     self.params = {}
     self.hooks = []
+    # state change events of this scan, see `DetectorRegistry`
+    self.detectors = detector_registry.create()
+    # learned marker search regions, see `roi.RoiTracker`
+    self.roi = None
+    # search regions of tracked markers after a hit
+    self.tracks : dict[MarkerName, tuple[slice, slice]] = {}
+    # state-gated marker search, see `MarkerSchedule`
+    self.schedule : MarkerSchedule | None = None
+    # sparse sampling of slow detectors and markers, see `SamplingSchedule`
+    self.sampling : SamplingSchedule | None = None
+    # compiled marker detection, see `VideoFrameEvent.compile_detection_plan`
+    self.plan : DetectionPlan | None = None
+    # thread pool matching markers of a frame concurrently
+    self.pool : concurrent.futures.Executor | None = None
+    # prefilter stage outcomes of this scan, see `cascade.CascadeStats`
+    self.cascade_stats : CascadeStats | None = None
 
   def __setitem__(self, state, value):
     if state not in self:
@@ -105,7 +312,27 @@ class VideoFrameData(VideoStateDict):
       changed_map = dict((key, new_values[key]) for key in set(old_values.keys()) | set(new_values.keys()) if key not in old_values or old_values[key] != new_values[key])
       self._trigger_hooks_(changed_map)
 
+  def export_event_context(self, time : tuple[int, float]) -> dict[str, typing.Any]:
+    '''
+    Collects carried context of state change events, relative to given frame time.
+    '''
+    return {
+      f.__name__: f.__export_context__(time)
+      for f in self.detectors
+      if hasattr(f, '__export_context__')
+    }
+
+  def import_event_context(self, context : dict[str, typing.Any], time : tuple[int, float]):
+    '''
+    Restores carried context of state change events, relative to given frame time.
+    '''
+    for f in self.detectors:
+      if f.__name__ in context and hasattr(f, '__import_context__'):
+        f.__import_context__(context[f.__name__], time)
+
   def _trigger_hooks_(self, state_map: dict[VideoState, bool]):
+    if self.sampling is not None:
+      self.sampling.alert(self.params['time'])
     for hook in self.hooks:
       if not callable(hook):
         continue
@@ -118,64 +345,164 @@ class VideoFrameEvent(VideoStateDict):
   default_marker_settings = {
     'single_color_mode': False,
     'template_mode': cv.TM_CCOEFF_NORMED,
+    # searches only around the last hit until a miss
+    'tracking': False,
+    # sampling cadence, see `SamplingSchedule`
+    'cadence': EVERY_FRAME,
+    # prefilter stages of color markers, see `cascade.DEFAULT_CASCADE`
+    # a marker rejecting its own hits disables it, or a stage of it, here
+    'cascade': {},
   }
 
   specific_marker_settings = {
     'battle-icon-clock': {
       'single_color_mode': True, 'detection_threshold': 0.92,
       'detection_region': (slice(0.6, None), slice(0.2)),
+      'tracking': True,
     },
     'battle-icon-pause': {
       'single_color_mode': True, 'detection_threshold': 0.8,
       'detection_region': (slice(0.6, None), slice(0.2)),
+      'tracking': True,
     },
     'battle-result-victory': { 'detection_threshold': 0.8 },
     # 'battle-result-defeat': { 'detection_threshold': 0.9 },
     'global-loading': {
       'single_color_mode': True,
       'detection_region': (slice(0.5, None), slice(0.8, None)),
+      'cadence': Cadence(ms=100),
     },
   }
 
-  state_change_events = []
-
-  def __init__(self, frame_data : VideoFrameData):
+  def __init__(self, frame_data : VideoFrameData, features : FrameFeatures | None = None):
     super().__init__(None)
     self.frame_data = frame_data
+    self.features = features
     self.marker_results : dict[str, MarkerResult] = dict()
 
-  def check_marker_relevance(self, marker_name : MarkerName) -> bool:
-    any_markers = object()
-    relevant_markers = set(
-      marker
-      for f in self.state_change_events
-      for marker in (
-        f.__required_markers__
-        if hasattr(f, '__required_markers__')
-        else set([any_markers])
-      )
-    )
-    if not relevant_markers or any_markers in relevant_markers:
-      return True
-    return marker_name in relevant_markers
+  def ensure_features(self, frame) -> FrameFeatures:
+    '''
+    Obtains derived features of given frame, shared by every detector.
+    '''
+    if self.features is None or self.features.frame is not frame:
+      self.features = FrameFeatures(frame)
+    return self.features
+
+  @classmethod
+  def compile_detection_plan(cls, resolution : tuple[int, int], params : dict, detectors : typing.Iterable[Detector]) -> DetectionPlan:
+    '''
+    Resolves settings of every marker required by given detectors for given frame resolution.
+    '''
+    markers = Markers
+    if params.get('scale_markers', False):
+      markers = scaled_markers(marker_scale(resolution[1]))
+
+    relevant_markers = required_markers(detectors)
+    planned_markers = []
+    for name, marker in markers.items():
+      if relevant_markers is not None and name not in relevant_markers:
+        continue
+      marker_settings = dict()
+      marker_settings.update(cls.default_marker_settings)
+      marker_settings['match_engine'] = params.get('match_engine', 'split')
+      # levels determined from marker size, see `matching.pyramid_levels`
+      marker_settings['pyramid_levels'] = None if params.get('pyramid_match', False) else 0
+      if name in cls.specific_marker_settings:
+        marker_settings.update(cls.specific_marker_settings[name])
+
+      tracking = marker_settings.pop('tracking')
+      cadence = marker_settings.pop('cadence')
+      planned_markers.append(PlannedMarker(
+        name, compile_marker_plan(marker, resolution, **marker_settings),
+        tracking, cadence, marker_settings.get('detection_region') is None,
+      ))
+
+    log.debug('Compiled detection plan of %d marker(s) at %dx%d.', len(planned_markers), *resolution)
+    return DetectionPlan(resolution, tuple(planned_markers))
+
+  @classmethod
+  def detection_plan(cls, frame_data : VideoFrameData, resolution : tuple[int, int], params : dict) -> DetectionPlan:
+    '''
+    Obtains detection plan of a scan, compiled again once the resolution changes.
+    '''
+    plan = frame_data.plan
+    if plan is None or plan.resolution != resolution:
+      plan = frame_data.plan = cls.compile_detection_plan(resolution, params, frame_data.detectors)
+    return plan
+
+  @classmethod
+  def batch_markers(cls, frame_data : VideoFrameData, features_list : list[FrameFeatures], params : dict):
+    '''
+    Matches markers with a fixed search region on several frames at once, see `marker.batch_marker_plan`.
+    '''
+    plan = cls.detection_plan(frame_data, features_list[0].shape[1::-1], params)
+    schedule = frame_data.schedule
+    for planned in plan.markers:
+      if schedule is not None and not schedule.relevant(planned.name):
+        continue
+      if planned.learned_region and frame_data.roi is not None:
+        continue
+      if batchable_marker_plan(planned.detection):
+        batch_marker_plan(features_list, planned.detection)
 
   def detect_markers_in_frame(self, frame):
-    self.marker_results = dict()
-    for name, marker in Markers.items():
-      if not self.check_marker_relevance(name):
+    features = self.ensure_features(frame)
+    frame_data = self.frame_data
+    time = frame_data.params.get('time')
+    resolution = features.shape[1::-1]
+    plan = self.detection_plan(frame_data, resolution, frame_data.params)
+
+    schedule = frame_data.schedule
+    if schedule is not None:
+      schedule.observe(frame_data.states)
+    sampling = frame_data.sampling
+    if sampling is not None:
+      sampling.observe(features, time)
+    roi = frame_data.roi
+    tracks = frame_data.tracks
+
+    jobs = []
+    for planned in plan.markers:
+      name = planned.name
+      if schedule is not None and not schedule.relevant(name):
         continue
-      marker_settings = dict()
-      marker_settings.update(self.default_marker_settings)
-      if name in self.specific_marker_settings:
-        marker_settings.update(self.specific_marker_settings[name])
+      if sampling is not None and not sampling.due(name, planned.cadence, time):
+        continue
+
+      detection_region = None
+      if roi is not None and planned.learned_region:
+        detection_region = roi.search_region(name, planned.detection.marker, resolution, time)
+      jobs.append((planned, detection_region, tracks.get(name) if planned.tracking else None))
 
-      self.marker_results[name] = detect_frame_with_marker(frame, marker, **marker_settings)
+    # matching releases the GIL, markers are matched concurrently when a pool is given
+    pool = frame_data.pool
+    cascade_stats = frame_data.cascade_stats
+    if pool is not None and len(jobs) > 1:
+      results = list(pool.map(lambda job: detect_planned_marker(features, *job, cascade_stats), jobs))
+    else:
+      results = [detect_planned_marker(features, *job, cascade_stats) for job in jobs]
+
+    self.marker_results = dict()
+    for (planned, _, _), result in zip(jobs, results):
+      name = planned.name
+      if planned.tracking and result.ok:
+        tracks[name] = tracking_region(result, resolution)
+      elif planned.tracking:
+        tracks.pop(name, None)
+
+      self.marker_results[name] = result
+      if roi is not None:
+        roi.observe(name, result, resolution, time)
 
   def prepare_state_changes_in_frame(self, frame):
     # reset state changes to None
     super().__init__(None)
+    self.ensure_features(frame)
 
-    for fun in self.state_change_events:
+    sampling = self.frame_data.sampling
+    for fun in self.frame_data.detectors:
+      if sampling is not None and not sampling.due(fun, getattr(fun, '__cadence__', EVERY_FRAME), self.frame_data.params['time']):
+        continue
       fun(self, frame)
 
     self.frame_data.update(self.states)
@@ -1,14 +1,20 @@
+import collections
 import contextlib
 import logging
-from collections import deque
+import concurrent.futures
 from dataclasses import dataclass, field
 
 import numpy as np
 import cv2 as cv
 
 from modules.types import Fraction
-from .state import VideoState, VideoFrameData, VideoFrameEvent
+from .state import VideoState, VideoFrameData, VideoFrameEvent, MarkerGate, MarkerSchedule, SamplingSchedule
+from .marker import MarkerName
 from .task_data import StateData
+from . import capture
+from . import cascade
+from . import roi
+from .frame import FrameFeatures, normalize_frame
 from . import frame_hooks
 from . import task_frame_hooks
 from . import utils
@@ -33,6 +39,13 @@ class ScanState():
   frame : np.ndarray = field(repr=False)
   frame_event : VideoFrameEvent
 
+  @property
+  def features(self) -> FrameFeatures:
+    '''
+    Proxy function.
+    '''
+    return self.frame_event.features
+
   @property
   def frame_data(self):
     '''
@@ -48,6 +61,29 @@ class ScanState():
     self.frame_event.prepare_state_changes_in_frame(self.frame)
     self.frame_data.update(self.frame_event.states)
 
+@dataclass(slots=True, frozen=True)
+class ScanSeed():
+  '''
+  Scan Seed object.
+
+  Carries states and detector context between Scanner instances
+  that scan consecutive parts of a video.
+  '''
+  states : dict[VideoState, bool]
+  context : dict = field(repr=False)
+  time : tuple[int, float]
+
+@dataclass(slots=True)
+class PendingFrame():
+  '''
+  Frame read ahead of scanning.
+  '''
+  frame : np.ndarray = field(repr=False)
+  features : FrameFeatures = field(repr=False)
+  time : tuple[int, float]
+  # frames outside scan windows were passed over before this frame
+  gap : bool
+
 class Scanner():
   '''
   Scanner object.
@@ -55,7 +91,18 @@ class Scanner():
   A class that defines Video Scanner environment.
   '''
 
-  def __init__(self, video_file, *, seek_option = None):
+  def __init__(
+    self, video_file, *,
+    seek_option = None, frame_limit = None, seed = None, frame_windows = None,
+    prefetch : int = 0, backend : str = 'opencv', decode_options : dict | None = None,
+    detection_height : int = 0, scale_markers : bool = False,
+    match_engine : str = 'split', pyramid_match : bool = False,
+    learn_regions : bool = False, region_widen_span : float = roi.ROI_WIDEN_SPAN,
+    marker_schedule : dict[MarkerName, MarkerGate] | None = None,
+    sampling_cadence : bool = False,
+    marker_threads : int = 0,
+    batch_frames : int = 0,
+  ):
     self.frame_count = 0
     self.frame_rate = 30
     self.frame_data = None
@@ -66,6 +113,37 @@ class Scanner():
     else:
       self.frame_start_seek = None
 
+    # stops scanning once reaching given frame position (exclusive)
+    self.frame_limit = frame_limit if isinstance(frame_limit, int) and frame_limit > 0 else None
+    # continues states and detector context from another scan
+    self.frame_seed = seed
+    # only scans frames within given sorted (start, stop) ranges, stop of None is unbounded
+    self.frame_windows = list(frame_windows) if frame_windows else None
+    # decodes up to given amount of frames ahead on a background thread
+    self.prefetch = prefetch if isinstance(prefetch, int) and prefetch > 0 else 0
+    # decoding backend and its options, see `capture.open_capture`
+    self.backend = backend
+    self.decode_options = dict(decode_options or {})
+    # resizes frames to given height before detection, markers are scaled along
+    self.detection_height = detection_height if isinstance(detection_height, int) and detection_height > 0 else 0
+    self.scale_markers = bool(scale_markers or self.detection_height)
+    # marker matching engine, see `marker.match_marker`
+    self.match_engine = match_engine
+    # matches large markers coarse-to-fine, see `matching.pyramid_match`
+    self.pyramid_match = pyramid_match
+    # searches markers only where they were found before, see `roi.RoiTracker`
+    self.learn_regions = learn_regions
+    self.region_widen_span = region_widen_span
+    # skips markers that can no longer change states, see `state.MarkerSchedule`
+    self.marker_schedule = dict(marker_schedule or {})
+    # samples slow detectors and markers sparsely, see `state.SamplingSchedule`
+    self.sampling_cadence = sampling_cadence
+    # matches markers of a frame on a thread pool of given size
+    # OpenCV threads are process wide, split once by the entry point, see `modules.task.split_opencv_threads`
+    self.marker_threads = marker_threads if isinstance(marker_threads, int) and marker_threads > 1 else 0
+    # reads given frames ahead, matching fixed-region markers on all of them at once
+    self.batch_frames = batch_frames if isinstance(batch_frames, int) and batch_frames > 1 else 0
+
     self.video_file = video_file
     self.video = None
 
@@ -82,8 +160,11 @@ class Scanner():
       self.__init_frame_data_hooks__()
 
     self.frame_cache = []
-    self.skip_history = deque(maxlen=100)
+    self.skip_history = utils.SkipHistory(100)
     self.iter_count = -1
+    self.window_index = 0
+    self.pending_frames = collections.deque()
+    self.end_frame_count = None
 
   def __init_frame_data_hooks__(self):
     '''
@@ -108,7 +189,10 @@ class Scanner():
   def params(self):
     return {
       'time': self.time,
-      'first_frame': self.iter_count < 1,
+      'first_frame': self.iter_count < 1 and self.frame_seed is None,
+      'scale_markers': self.scale_markers,
+      'match_engine': self.match_engine,
+      'pyramid_match': self.pyramid_match,
     }
 
   def __iter__(self):
@@ -121,20 +205,67 @@ class Scanner():
     if not self.video.isOpened():
       raise StopIteration('Video is not yet opened')
 
-    similar_threshold = utils.calculate_similarity_threshold(self, FRAME_SKIP_SIMILAR_THRESHOLD, 0.15)
+    if not self.pending_frames:
+      self.read_ahead()
+    if not self.pending_frames:
+      self.frame_count = self.end_frame_count
+      raise StopIteration()
+
+    pending = self.pending_frames.popleft()
+    features = pending.features
+    # only the last accepted frame is compared against
+    if features.previous is not None:
+      features.previous.detach_previous()
+    if pending.gap:
+      # tracked markers may have moved across the gap
+      self.frame_data.tracks.clear()
+
+    self.frame_count, self.frame_rate = pending.time
+    self.iter_count += 1
+    self.frame_data.params = self.params
+
+    return ScanState(pending.frame, VideoFrameEvent(self.frame_data, features))
+
+  def read_ahead(self):
+    '''
+    Reads frames to be scanned next, matching batchable markers on all of them at once.
+    '''
+    while len(self.pending_frames) < max(1, self.batch_frames) and self.end_frame_count is None:
+      self.read_frame()
+
+    if len(self.pending_frames) > 1:
+      VideoFrameEvent.batch_markers(
+        self.frame_data,
+        [pending.features for pending in self.pending_frames],
+        self.params,
+      )
+
+  def read_frame(self):
+    '''
+    Reads until a frame not similar to the last accepted frame, queues it for scanning.
+    '''
+    similar_threshold = self.skip_history.similarity_threshold(FRAME_SKIP_SIMILAR_THRESHOLD, 0.15)
 
     skip_count = 0
+    gap = False
     while True: # Find until not similar or EoF
       ret, frame = self.video.read()
-      if not ret:
-        self.frame_count += skip_count
-        raise StopIteration()
+      if not ret or self.limit_reached():
+        self.end_frame_count = self.frame_count + skip_count
+        return
 
-      if len(self.frame_cache) >= 1 and check_similarity(self.frame_cache[-1], frame, threshold = similar_threshold):
+      if not self.within_windows():
+        skip_count = 0
+        gap = True
+        continue
+
+      frame = normalize_frame(frame, self.detection_height)
+      features = FrameFeatures(frame, self.frame_cache[-1] if self.frame_cache else None)
+      if features.previous is not None and features.similarity >= similar_threshold:
         skip_count += 1
         continue
 
-      self.frame_cache.append(frame)
+      self.frame_cache.append(features)
       while len(self.frame_cache) > 2:
         self.frame_cache.pop(0)
 
@@ -146,14 +277,104 @@ class Scanner():
 
     self.frame_count, self.frame_rate = \
       int(self.video.get(cv.CAP_PROP_POS_FRAMES) - 1), self.video.get(cv.CAP_PROP_FPS)
-    self.iter_count += 1
-    self.frame_data.params = self.params
+    self.pending_frames.append(PendingFrame(frame, features, self.time, gap))
 
-    return ScanState(frame, VideoFrameEvent(self.frame_data))
+  def limit_reached(self) -> bool:
+    '''
+    Checks whether the last read frame is beyond the frame limit.
+    '''
+    if self.frame_limit is None:
+      return False
+    return self.video.get(cv.CAP_PROP_POS_FRAMES) > self.frame_limit
+
+  def within_windows(self) -> bool:
+    '''
+    Checks whether the last read frame is within scanning windows.
+
+    Seeks to the next window otherwise.
+    '''
+    if self.frame_windows is None:
+      return True
+
+    position = int(self.video.get(cv.CAP_PROP_POS_FRAMES)) - 1
+    while self.window_index < len(self.frame_windows):
+      start, stop = self.frame_windows[self.window_index]
+      if stop is not None and position >= stop:
+        self.window_index += 1
+        continue
+      if position >= start:
+        return True
+
+      self.video.set(cv.CAP_PROP_POS_FRAMES, max(0, start - 1))
+      self.frame_cache.clear()
+      if start > 0:
+        # first frame of the window is compared against the frame before it
+        ret, frame = self.video.read()
+        if ret:
+          self.frame_cache.append(FrameFeatures(normalize_frame(frame, self.detection_height)))
+      return False
+
+    # no windows left, jump to end-of-file
+    frame_total = int(self.video.get(cv.CAP_PROP_FRAME_COUNT))
+    self.video.set(cv.CAP_PROP_POS_FRAMES, frame_total)
+    self.frame_count = frame_total - 1
+    self.frame_cache.clear()
+    return False
+
+  def snapshot(self, frame : int | None = None):
+    '''
+    Captures current states and detector context to continue scanning elsewhere.
+
+    Context is taken relative to given frame, defaults to current frame.
+    '''
+    time = (self.frame_count if frame is None else frame, self.frame_rate)
+    return ScanSeed(
+      dict(self.frame_data.states),
+      self.frame_data.export_event_context(time),
+      time,
+    )
+
+  def prepare_frame_data(self):
+    '''
+    Sets up per-scan detection state and seeded states of the frame data.
+    '''
+    self.frame_data.cascade_stats = cascade.CascadeStats()
+    if self.learn_regions:
+      self.frame_data.roi = roi.RoiTracker(self.region_widen_span)
+    # states before a seeded or seeked start are unknown, every marker is kept
+    if self.marker_schedule and self.frame_seed is None and self.frame_start_seek is None:
+      self.frame_data.schedule = MarkerSchedule(self.marker_schedule)
+    if self.sampling_cadence:
+      self.frame_data.sampling = SamplingSchedule()
+    if self.marker_threads:
+      self.frame_data.pool = concurrent.futures.ThreadPoolExecutor(self.marker_threads, thread_name_prefix='marker')
+
+    # Apply seeded states without triggering hooks
+    if self.frame_seed is not None:
+      self.frame_data.states.update(self.frame_seed.states)
+      self.frame_data.import_event_context(self.frame_seed.context, self.frame_seed.time)
+
+  def finish_scan(self):
+    '''
+    Logs end-of-file state and releases per-scan detection state.
+    '''
+    if self.frame_count >= 0:
+      self.state_logs.append(StateData(
+        Fraction(self.frame_count, int(self.frame_rate)),
+        {VideoState.EOF: True},
+      ))
+
+    if debug_flags.SHOW_CASCADE_STATS:
+      self.frame_data.cascade_stats.log()
+    if self.frame_data.roi is not None:
+      self.frame_data.roi.store()
+    if self.frame_data.pool is not None:
+      self.frame_data.pool.shutdown()
+      self.frame_data.pool = None
 
   def __enter__(self):
     self.__init_transient_variables__()
-    self.video = cv.VideoCapture(self.video_file)
+    self.video = capture.open_capture(self.video_file, self.backend, **self.decode_options)
 
     # Apply seeking if necessary
     if self.frame_start_seek is not None:
@@ -161,25 +382,24 @@ class Scanner():
       if seek_type in (cv.CAP_PROP_POS_MSEC, cv.CAP_PROP_POS_FRAMES):
         self.video.set(seek_type, seek_value)
 
+    if self.prefetch:
+      self.video = capture.PrefetchCapture(self.video, self.prefetch)
+
+    self.prepare_frame_data()
     return self, self.video
 
   def __exit__(self, *exc):
-    if self.frame_count >= 0:
-      self.state_logs.append(StateData(
-        Fraction(self.frame_count, int(self.frame_rate)),
-        {VideoState.EOF: True},
-      ))
-
+    self.finish_scan()
     self.video.release()
     self.frame_count = -1
     return False
 
 @contextlib.contextmanager
-def open_video_file(file):
+def open_video_file(file, backend = 'opencv', **decode_options):
   '''
   Opens video file manually without using Video Scan object.
   '''
-  video = cv.VideoCapture(file)
+  video = capture.open_capture(file, backend, **decode_options)
 
   try:
     yield video
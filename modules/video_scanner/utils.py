@@ -1,20 +1,63 @@
+import math
+from collections import deque, Counter
+
 import numpy as np
 import cv2 as cv
 
+from .frame import gray_frame
+
 def calculate_similarity(previous_frame, current_frame) -> float:
   '''
   Calculates similarity between two frames.
   '''
   difference = cv.absdiff(current_frame, previous_frame)
-  difference = cv.cvtColor(difference, cv.COLOR_BGR2GRAY)
+  difference = gray_frame(difference, cv.COLOR_BGR2GRAY)
   score = cv.calcHist([difference], [0], None, [4], [0, 256])
   score = 100 * score / score.sum()
 
   return score[0]
 
+# Darkness constants
+DARK_VALUE_THRESHOLD = 5
+DARK_DOMINANCE_THRESHOLD = 70
+DARK_COMPLETE_THRESHOLD = 95
+
+def create_rectangle_mask(frame, offset : int, color : int):
+  '''
+  Creates a mask that excludes a rectangle inset by given offset.
+  '''
+  mask = np.full(frame.shape[:2], 255, dtype='uint8')
+  cv.rectangle(
+    mask,
+    (offset, offset),
+    (frame.shape[0] - offset, frame.shape[1] - offset),
+    color,
+    -1,
+  )
+  return mask
+
+def measure_darkness(frame, mask = None) -> tuple[bool, bool]:
+  '''
+  Checks whether a frame is mostly dark, and completely dark.
+  '''
+  gray_hist  = cv.calcHist([gray_frame(frame, cv.COLOR_RGB2GRAY)], [0], mask, [256], [0, 256])
+
+  total_dark_pixels = gray_hist[:DARK_VALUE_THRESHOLD].sum()
+  ratio_dark_pixels = total_dark_pixels / gray_hist.sum()
+  is_gray_dark  = ratio_dark_pixels * 100 >= DARK_DOMINANCE_THRESHOLD
+  is_gray_black = ratio_dark_pixels * 100 >= DARK_COMPLETE_THRESHOLD
+
+  return is_gray_dark, is_gray_black
+
 def slice_to_pixels(frame, coord : tuple[slice, slice]) -> tuple[slice, slice]:
   '''
-  Converts given coordinate slice into pixels.
+  Converts given coordinate slice into pixels of a frame, see `region_to_pixels`.
+  '''
+  return region_to_pixels(frame.shape[1::-1], coord)
+
+def region_to_pixels(resolution : tuple[int, int], coord : tuple[slice, slice]) -> tuple[slice, slice]:
+  '''
+  Converts given coordinate slice into pixels of a frame resolution.
 
   Absolute References:
     slice(m:int,   n:int)   -> slice(m, n)
@@ -49,10 +92,9 @@ def slice_to_pixels(frame, coord : tuple[slice, slice]) -> tuple[slice, slice]:
 
     return slice(start, stop)
 
-  frame_shape = frame.shape[-2::-1]
   return tuple(
     translate_slice(size, point)
-    for point, size in zip(coord, frame_shape)
+    for point, size in zip(coord, resolution)
   )
 
 def calculate_detection_threshold(frame, marker) -> float:
@@ -111,3 +153,126 @@ def calculate_similarity_threshold(scanner, start_threshold : float, reduce_thre
   threshold_rate = 1.0 - reduce_threshold * ((criterion_count / criterion_threshold) ** 1.5)
 
   return start_threshold * threshold_rate
+
+class SkipHistory():
+  '''
+  Rolling history of frame skip counts.
+
+  Keeps the sum, non-zero count and count of each value updated on append,
+  along with runs of short skips for the bound last asked for,
+  so the adaptive similarity threshold never walks the whole history.
+  Yields the same threshold as `calculate_similarity_threshold`.
+  '''
+
+  def __init__(self, maxlen : int = 100):
+    self.maxlen = maxlen
+    self.skips = deque()
+    self.total = 0
+    self.nonzero = 0
+    self.counts = Counter()
+
+    # lengths of runs of skips within (0, run_bound], oldest first
+    self.run_bound = None
+    self.runs = deque()
+    self.run_open = False
+
+  def __len__(self):
+    return len(self.skips)
+
+  def __iter__(self):
+    return iter(self.skips)
+
+  def __getitem__(self, index):
+    return self.skips[index]
+
+  def in_run(self, skip : int) -> bool:
+    return 0 < skip <= self.run_bound
+
+  def append(self, skip : int):
+    if len(self.skips) >= self.maxlen:
+      self.expire(self.skips.popleft())
+
+    self.skips.append(skip)
+    self.total += skip
+    self.counts[skip] += 1
+    if skip:
+      self.nonzero += 1
+
+    if self.run_bound is None:
+      return
+    if not self.in_run(skip):
+      self.run_open = False
+    elif self.run_open:
+      self.runs[-1] += 1
+    else:
+      self.runs.append(1)
+      self.run_open = True
+
+  def expire(self, skip : int):
+    self.total -= skip
+    self.counts[skip] -= 1
+    if not self.counts[skip]:
+      del self.counts[skip]
+    if skip:
+      self.nonzero -= 1
+
+    if self.run_bound is None or not self.in_run(skip):
+      return
+    self.runs[0] -= 1
+    if not self.runs[0]:
+      self.runs.popleft()
+      if not self.runs:
+        self.run_open = False
+
+  def longest_run(self, bound : int) -> int:
+    '''
+    Length of the longest run of skips within (0, bound].
+    '''
+    if bound != self.run_bound:
+      self.run_bound = bound
+      self.runs.clear()
+      self.run_open = False
+      for skip in self.skips:
+        if not self.in_run(skip):
+          self.run_open = False
+        elif self.run_open:
+          self.runs[-1] += 1
+        else:
+          self.runs.append(1)
+          self.run_open = True
+
+    return max(self.runs, default=0)
+
+  def count_within(self, bound : int) -> int:
+    '''
+    Count of skips within (0, bound].
+    '''
+    if bound < len(self.counts):
+      return sum(self.counts.get(skip, 0) for skip in range(1, bound + 1))
+    return sum(count for skip, count in self.counts.items() if 0 < skip <= bound)
+
+  def similarity_threshold(self, start_threshold : float, reduce_threshold : float = 0.05) -> float:
+    '''
+    Calculates adjusted similarity threshold, see `calculate_similarity_threshold`.
+    '''
+    def below_bound(limit):
+      # integer skips below given limit
+      return math.ceil(limit) - 1
+
+    if len(self.skips) <= max(5, self.maxlen // 10):
+      return start_threshold
+
+    criterion_threshold = max(5, int(self.maxlen * 0.4))
+    calculated_average = (np.float64(self.total) / len(self.skips)) ** 0.5
+    contiguous_rate = self.longest_run(below_bound(max(1, calculated_average)))
+    ave_nerf_rate = 1 - 0.5 * min(1, max(0, contiguous_rate - 5) / criterion_threshold)
+    if self.nonzero:
+      criterion_count = self.count_within(
+        below_bound(max(1, ave_nerf_rate * (np.float64(self.total) / self.nonzero) ** 0.5)),
+      )
+    else:
+      criterion_count = 0
+    criterion_count = min(criterion_threshold, max(0, criterion_count - 5))
+    threshold_rate = 1.0 - reduce_threshold * ((criterion_count / criterion_threshold) ** 1.5)
+
+    return start_threshold * threshold_rate
@@ -0,0 +1,112 @@
+import os
+import shutil
+
+import numpy as np
+import cv2 as cv
+import pytest
+
+from modules.video_scanner import detect # noqa: F401
+from modules.video_scanner.marker import MARKER_FOLDER
+from modules.video_scanner.task import Scanner
+from modules.video_scanner.task_data import StateData
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# `modules.task` and game modules query FFMPEG version on import.
+requires_ffmpeg = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='FFMPEG is not installed')
+
+# Synthetic recording, (width, height) and frames per second.
+CLIP_SIZE = (1920, 1080)
+CLIP_RATE = 10
+CLIP_FRAMES = 100
+
+# States scanned from the synthetic recording, by frame.
+BASELINE_STATES = [
+  (0, {'UNIT_SELECT': True}),
+  (20, {'UNIT_SELECT': False, 'SCREEN_DARK': True, 'SCREEN_BLACK': True, 'LOADING_FLAG': True}),
+  (30, {'SCREEN_DARK': False, 'SCREEN_BLACK': False, 'LOADING_FLAG': False, 'GAMEPLAY_DETECT': True}),
+  (70, {'GAMEPLAY_DETECT': False, 'GAMEPLAY_CONCLUDE_SUCCESS': True}),
+  (90, {'SCREEN_DARK': True, 'SCREEN_BLACK': True, 'GAMEPLAY_CONCLUDE_SUCCESS': False, 'GAMEPLAY_CONCLUDE_WAIT': True}),
+  (99, {'EOF': True}),
+]
+
+def load_marker_image(name : str) -> np.ndarray:
+  return cv.imread(os.path.join(ROOT_DIR, MARKER_FOLDER, name + '.png'), cv.IMREAD_UNCHANGED)
+
+def paste_marker(frame : np.ndarray, image : np.ndarray, x : int, y : int):
+  '''
+  Blends a marker image with alpha into the frame.
+  '''
+  height, width = image.shape[:2]
+  alpha = image[..., 3:4].astype(np.float32) / 255 if image.shape[2] > 3 else 1
+  region = frame[y:y + height, x:x + width].astype(np.float32)
+  frame[y:y + height, x:x + width] = (image[..., :3] * alpha + region * (1 - alpha)).astype(np.uint8)
+
+def synthetic_frame(background : np.ndarray, n : int) -> np.ndarray:
+  '''
+  Frame of a recording going through formation, loading, battle and its result.
+  '''
+  time = n / CLIP_RATE
+  frame = background.copy()
+  # moving block so no frame is skipped as similar
+  x = 100 + (n * 37) % 600
+  cv.rectangle(frame, (x, 500), (x + 200, 700), ((n * 13) % 255, 80, 160), -1)
+
+  if time < 2:
+    paste_marker(frame, load_marker_image('formation-icons'), 1500, 300)
+  elif time < 3:
+    frame[:] = 0
+    paste_marker(frame, load_marker_image('global-loading'), 1600, 1000)
+  elif time < 7:
+    paste_marker(frame, load_marker_image('battle-icon-clock'), 1700, 60)
+    paste_marker(frame, load_marker_image('battle-icon-pause'), 1800, 40)
+  elif time < 9:
+    paste_marker(frame, load_marker_image('battle-result-victory'), 520, 400)
+  else:
+    frame[:] = 0
+  return frame
+
+def state_timeline(state_logs : list[StateData]) -> list[tuple[int, dict[str, bool]]]:
+  return [
+    (state_log.time.numerator, {state.name: value for state, value in state_log.states.items()})
+    for state_log in state_logs
+  ]
+
+def scan_states(video_file : str, **scanner_options) -> list[StateData]:
+  with Scanner(video_file, **scanner_options) as (scanner, video):
+    for scan_state in scanner:
+      scan_state.process()
+  return scanner.state_logs
+
+@pytest.fixture(scope='session', autouse=True)
+def repo_root():
+  '''
+  Markers and caches are resolved relative to the repository root.
+  '''
+  with pytest.MonkeyPatch.context() as mp:
+    mp.chdir(ROOT_DIR)
+    yield ROOT_DIR
+
+@pytest.fixture(scope='session')
+def synthetic_video(tmp_path_factory) -> str:
+  '''
+  Lossless recording made of detection markers.
+  '''
+  path = str(tmp_path_factory.mktemp('video') / 'synthetic.avi')
+  rng = np.random.default_rng(0)
+  background = cv.resize(rng.integers(60, 200, (27, 48, 3), dtype=np.uint8), CLIP_SIZE, interpolation=cv.INTER_LINEAR)
+
+  writer = cv.VideoWriter(path, cv.VideoWriter_fourcc(*'FFV1'), CLIP_RATE, CLIP_SIZE)
+  if not writer.isOpened():
+    pytest.skip('FFV1 encoder is not available')
+  for n in range(CLIP_FRAMES):
+    writer.write(synthetic_frame(background, n))
+  writer.release()
+  return path
+
+@pytest.fixture(scope='session')
+def baseline_states(synthetic_video) -> list[StateData]:
+  '''
+  States of a plain frame-by-frame scan.
+  '''
+  return scan_states(synthetic_video)
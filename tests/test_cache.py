@@ -0,0 +1,66 @@
+import shutil
+
+import pytest
+
+from modules.video_scanner import cache as scan_cache
+
+from .conftest import requires_ffmpeg, state_timeline
+
+@pytest.fixture(autouse=True)
+def cache_folder(tmp_path, monkeypatch):
+  monkeypatch.setattr(scan_cache, 'CACHE_FOLDER', str(tmp_path / 'scan'))
+  return tmp_path / 'scan'
+
+def test_cached_states_round_trip(synthetic_video, baseline_states):
+  assert scan_cache.load_state_logs(synthetic_video, salt = 'a') is None
+  scan_cache.store_state_logs(synthetic_video, baseline_states, salt = 'a')
+  assert state_timeline(scan_cache.load_state_logs(synthetic_video, salt = 'a')) == state_timeline(baseline_states)
+
+def test_cached_states_keyed_by_salt(synthetic_video, baseline_states):
+  scan_cache.store_state_logs(synthetic_video, baseline_states, salt = 'a')
+  assert scan_cache.load_state_logs(synthetic_video, salt = 'b') is None
+
+def test_cached_states_keyed_by_file_content(synthetic_video, baseline_states, tmp_path):
+  copied_video = str(tmp_path / 'copied.avi')
+  shutil.copyfile(synthetic_video, copied_video)
+  scan_cache.store_state_logs(copied_video, baseline_states)
+  assert scan_cache.load_state_logs(copied_video) is not None
+
+  with open(copied_video, 'ab') as f:
+    f.write(b'\0')
+  assert scan_cache.load_state_logs(copied_video) is None
+
+def test_broken_cache_entry_is_ignored(synthetic_video, baseline_states):
+  scan_cache.store_state_logs(synthetic_video, baseline_states)
+  with open(scan_cache.cache_path(synthetic_video, 'states'), 'w') as f:
+    f.write('{')
+  assert scan_cache.load_state_logs(synthetic_video) is None
+
+@requires_ffmpeg
+def test_cache_salt_ignores_neutral_options():
+  from modules import task
+  assert task.cache_salt({'match_engine': 'split'}) == task.cache_salt({'match_engine': 'split', 'prefetch': 8})
+  assert task.cache_salt({'match_engine': 'split'}) != task.cache_salt({'match_engine': 'fft'})
+
+@requires_ffmpeg
+def test_cache_salt_drops_regions_of_pipeline_scans():
+  from modules import task
+  options = {'pipeline_workers': 2, 'learn_regions': True}
+  assert task.effective_scan_options(options)['learn_regions'] is False
+  assert task.effective_scan_options(options, jobs = 2)['learn_regions'] is True
+
+@requires_ffmpeg
+def test_scan_video_timing_uses_salted_cache(synthetic_video, baseline_states):
+  from modules import task
+  assert state_timeline(task.scan_video_timing(synthetic_video)) == state_timeline(baseline_states)
+  assert scan_cache.load_state_logs(synthetic_video, salt = task.cache_salt({})) is not None
+  assert scan_cache.load_state_logs(synthetic_video, salt = task.cache_salt({'match_engine': 'fft'})) is None
+
+@requires_ffmpeg
+def test_cached_splits_salted_with_scan_options(monkeypatch):
+  from game_modules.blue_archive import action
+  salt = action.splits_cache_salt()
+  monkeypatch.setitem(action.SCAN_OPTIONS, 'prefetch', 8)
+  assert action.splits_cache_salt() == salt
+  monkeypatch.setitem(action.SCAN_OPTIONS, 'match_engine', 'fft')
+  assert action.splits_cache_salt() != salt
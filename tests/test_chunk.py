@@ -0,0 +1,32 @@
+import pytest
+
+from modules.video_scanner.chunk import ChunkPlan, plan_chunks, scan_chunk, stitch_chunks
+
+from .conftest import BASELINE_STATES, state_timeline
+
+def test_full_scan_matches_baseline(baseline_states):
+  assert state_timeline(baseline_states) == BASELINE_STATES
+
+@pytest.mark.parametrize('frame_total, jobs', [(100, 4), (3000, 4), (3001, 3), (12000, 16)])
+def test_plan_chunks_cover_every_frame(frame_total, jobs):
+  plans = plan_chunks(frame_total, 30, jobs)
+  assert plans[0].start == 0
+  assert plans[-1].stop is None
+  for previous, current in zip(plans, plans[1:]):
+    assert previous.stop == current.start
+    assert current.warmup <= current.start
+
+@pytest.fixture(scope='module')
+def first_chunk(synthetic_video):
+  return scan_chunk(synthetic_video, ChunkPlan(0, 0, 0, 70))
+
+def test_stitched_chunks_match_full_scan(synthetic_video, baseline_states, first_chunk):
+  second_chunk = scan_chunk(synthetic_video, ChunkPlan(1, 0, 70, None))
+  assert second_chunk.continues(first_chunk)
+  assert state_timeline(stitch_chunks(synthetic_video, [second_chunk, first_chunk])) == state_timeline(baseline_states)
+
+def test_chunk_warmed_up_differently_is_rescanned(synthetic_video, baseline_states, first_chunk):
+  # warmup misses when the gameplay started
+  second_chunk = scan_chunk(synthetic_video, ChunkPlan(1, 60, 70, None))
+  assert not second_chunk.continues(first_chunk)
+  assert state_timeline(stitch_chunks(synthetic_video, [first_chunk, second_chunk])) == state_timeline(baseline_states)
@@ -0,0 +1,37 @@
+import pytest
+
+from modules.video_scanner.detect import CONTEXT_HORIZON
+from modules.video_scanner.coarse import ProbeResult, probe_frames, plan_windows, scan_video_refined
+
+from .conftest import CLIP_FRAMES, CLIP_RATE, state_timeline
+
+PROBE_INTERVAL = 5
+
+def test_plan_windows_without_changes():
+  probes = [ProbeResult(n, ((), False)) for n in range(0, 300, 10)]
+  assert plan_windows(probes, 10, 1) == [(0, 10), (280, None)]
+
+def test_plan_windows_around_changes():
+  probes = [ProbeResult(n, ((), n >= 150)) for n in range(0, 300, 10)]
+  probes[20] = ProbeResult(200, ((), True), similarity = 50.0)
+  # one frame per second
+  assert plan_windows(probes, 10, 1) == [(0, 10), (130, 150 + CONTEXT_HORIZON), (180, 200 + CONTEXT_HORIZON), (280, None)]
+
+@pytest.fixture(scope='module')
+def probes(synthetic_video):
+  return probe_frames(synthetic_video, PROBE_INTERVAL)
+
+def test_probes_cover_video(probes):
+  results, frame_total, frame_rate = probes
+  assert frame_total == CLIP_FRAMES
+  assert frame_rate == CLIP_RATE
+  assert [probe.frame for probe in results] == list(range(0, CLIP_FRAMES, PROBE_INTERVAL))
+
+def test_refined_windows_skip_steady_frames(probes):
+  results, frame_total, frame_rate = probes
+  windows = plan_windows(results, PROBE_INTERVAL, frame_rate)
+  assert sum((stop if stop is not None else frame_total) - start for start, stop in windows) < frame_total
+
+def test_refined_scan_matches_full_scan(synthetic_video, baseline_states):
+  state_logs = scan_video_refined(synthetic_video, probe_interval = PROBE_INTERVAL)
+  assert state_timeline(state_logs) == state_timeline(baseline_states)
@@ -0,0 +1,44 @@
+import concurrent.futures
+
+from modules.video_scanner.state import DetectorRegistry, VideoFrameData, detector_registry, required_markers
+
+from .conftest import scan_states, state_timeline
+
+def detect_nothing(frame_event, frame):
+  pass
+
+def test_registry_creates_factory_detectors_per_call():
+  calls = []
+
+  def factory():
+    def detect_counted(frame_event, frame):
+      calls.append(frame)
+    return (detect_counted,)
+
+  registry = DetectorRegistry()
+  registry.register(detect_nothing)
+  registry.register_factory(factory)
+  registry.register(detect_nothing)
+  registry.register_factory(factory)
+
+  first, second = registry.create(), registry.create()
+  assert len(first) == 2
+  assert first[0] is second[0] is detect_nothing
+  assert first[1] is not second[1]
+
+def test_scans_get_their_own_detectors():
+  first, second = VideoFrameData().detectors, VideoFrameData().detectors
+  assert [f.__name__ for f in first] == [f.__name__ for f in second]
+  assert any(a is not b for a, b in zip(first, second))
+  assert len(first) == len(detector_registry.create())
+
+def test_detectors_declare_required_markers():
+  markers = required_markers(detector_registry.create())
+  assert markers is not None
+  assert {'battle-result-victory', 'battle-result-defeat', 'formation-icons'} <= markers
+
+def test_concurrent_scans_match_full_scan(synthetic_video, baseline_states):
+  with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+    results = list(executor.map(lambda _: scan_states(synthetic_video), range(2)))
+  for state_logs in results:
+    assert state_timeline(state_logs) == state_timeline(baseline_states)
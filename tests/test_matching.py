@@ -0,0 +1,69 @@
+import numpy as np
+import cv2 as cv
+import pytest
+
+from modules.video_scanner import matching
+from modules.video_scanner.frame import FrameFeatures
+from modules.video_scanner.marker import load_markers
+
+from .conftest import paste_marker
+
+# Score difference allowed against per-channel matching.
+SCORE_TOLERANCE = 1e-4
+MARGIN = 24
+
+@pytest.fixture(scope='module')
+def markers():
+  return load_markers()
+
+def marker_region(marker, seed : int = 0) -> tuple[np.ndarray, tuple[int, int]]:
+  '''
+  Noisy region with the marker pasted at a known position.
+  '''
+  rng = np.random.default_rng(seed)
+  region = rng.integers(0, 256, (marker.height + 2 * MARGIN, marker.width + 2 * MARGIN, 3), dtype=np.uint8)
+  position = (MARGIN // 2, MARGIN + 3)
+  paste_marker(region, marker.data, *position)
+  return region, position
+
+def split_scores(region : np.ndarray, marker) -> np.ndarray:
+  '''
+  Reference scores, `cv.matchTemplate` on every channel with the marker mask.
+  '''
+  return sum(
+    cv.matchTemplate(channel, channel_marker, cv.TM_CCOEFF_NORMED, mask=marker.alpha_channel)
+    for channel, channel_marker in zip(cv.split(region), marker.color_channels)
+  ) / 3
+
+@pytest.mark.parametrize('name', ['battle-result-defeat', 'battle-result-victory', 'formation-icons', 'ios-screen-record-icon'])
+@pytest.mark.parametrize('match', [matching.fused_match, matching.fft_match], ids=['fused', 'fft'])
+def test_masked_scores_match_split_engine(markers, name, match):
+  marker = markers[name]
+  region, position = marker_region(marker)
+  expected = split_scores(region, marker)
+  scores = match(FrameFeatures(region), marker.color_template)
+
+  assert scores.shape == expected.shape
+  assert np.all(np.isfinite(scores))
+  finite = np.isfinite(expected)
+  assert np.abs(scores[finite] - expected[finite]).max() < SCORE_TOLERANCE
+  assert np.unravel_index(np.argmax(scores), scores.shape)[::-1] == position
+
+def test_masked_match_matches_split_engine(markers):
+  marker = markers['battle-result-victory']
+  region, position = marker_region(marker, seed = 1)
+  channels = tuple(channel.astype(np.float32) for channel in cv.split(region))
+  scores = matching.masked_match(channels, marker.color_template)
+
+  expected = split_scores(region, marker)
+  assert np.abs(scores - expected).max() < SCORE_TOLERANCE
+  assert np.unravel_index(np.argmax(scores), scores.shape)[::-1] == position
+
+@pytest.mark.parametrize('name', ['battle-result-victory', 'formation-icons'])
+@pytest.mark.parametrize('match', [matching.fused_match, matching.fft_match], ids=['fused', 'fft'])
+def test_flat_region_scores_finite(markers, name, match):
+  marker = markers[name]
+  region = np.full((marker.height + MARGIN, marker.width + MARGIN, 3), 128, dtype=np.uint8)
+  scores = match(FrameFeatures(region), marker.color_template)
+  assert np.all(np.isfinite(scores))
+  assert np.all(np.abs(scores) <= 1)
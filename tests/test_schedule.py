@@ -0,0 +1,79 @@
+from modules.video_scanner.state import VideoState, MarkerGate, MarkerSchedule
+
+from .conftest import requires_ffmpeg, scan_states, state_timeline
+
+GATES = {
+  'battle-result-victory': MarkerGate(after = (VideoState.GAMEPLAY_DETECT,)),
+  'formation-icons': MarkerGate(
+    until = (VideoState.LOADING_SCREEN,),
+    rearm = (VideoState.GAMEPLAY_CONCLUDE_SUCCESS, VideoState.GAMEPLAY_CONCLUDE_FAILURE),
+  ),
+  'global-loading': MarkerGate(until = (VideoState.GAMEPLAY_DETECT,)),
+}
+
+def test_ungated_marker_always_relevant():
+  schedule = MarkerSchedule(GATES)
+  assert schedule.relevant('battle-icon-clock')
+  schedule.observe({VideoState.GAMEPLAY_DETECT: True})
+  assert schedule.relevant('battle-icon-clock')
+
+def test_marker_searched_after_its_states():
+  schedule = MarkerSchedule(GATES)
+  assert not schedule.relevant('battle-result-victory')
+  schedule.observe({VideoState.GAMEPLAY_DETECT: True})
+  assert schedule.relevant('battle-result-victory')
+  schedule.observe({VideoState.GAMEPLAY_DETECT: False})
+  assert schedule.relevant('battle-result-victory')
+
+def test_marker_retired_until_its_states():
+  schedule = MarkerSchedule(GATES)
+  assert schedule.relevant('global-loading')
+  schedule.observe({VideoState.GAMEPLAY_DETECT: True})
+  schedule.observe({VideoState.GAMEPLAY_DETECT: False})
+  assert not schedule.relevant('global-loading')
+  assert schedule.retired() == frozenset(['global-loading'])
+
+def test_marker_rearmed_after_attempt_concludes():
+  schedule = MarkerSchedule(GATES)
+  attempt = [
+    {VideoState.UNIT_SELECT: True},
+    {VideoState.LOADING_SCREEN: True},
+    {VideoState.GAMEPLAY_DETECT: True},
+  ]
+  for states in attempt:
+    schedule.observe(states)
+  assert not schedule.relevant('formation-icons')
+  # suspended markers still come back, detector processes keep matching them
+  assert 'formation-icons' not in schedule.retired()
+
+  schedule.observe({VideoState.GAMEPLAY_CONCLUDE_FAILURE: True})
+  assert schedule.relevant('formation-icons')
+  for states in attempt:
+    schedule.observe(states)
+  assert not schedule.relevant('formation-icons')
+
+def test_held_state_does_not_rearm_again():
+  schedule = MarkerSchedule(GATES)
+  schedule.observe({VideoState.LOADING_SCREEN: True})
+  schedule.observe({VideoState.GAMEPLAY_CONCLUDE_SUCCESS: True})
+  schedule.observe({VideoState.GAMEPLAY_CONCLUDE_SUCCESS: True, VideoState.LOADING_SCREEN: True})
+  assert not schedule.relevant('formation-icons')
+  schedule.observe({VideoState.GAMEPLAY_CONCLUDE_SUCCESS: True, VideoState.LOADING_SCREEN: True})
+  assert not schedule.relevant('formation-icons')
+
+def test_gated_scan_matches_full_scan(synthetic_video, baseline_states):
+  gates = {
+    **GATES,
+    # the recording shows no loading screen, retire on its black screen instead
+    'formation-icons': MarkerGate(until = (VideoState.SCREEN_BLACK,), rearm = (VideoState.GAMEPLAY_CONCLUDE_SUCCESS,)),
+  }
+  assert state_timeline(scan_states(synthetic_video, marker_schedule = gates)) == state_timeline(baseline_states)
+
+@requires_ffmpeg
+def test_formation_rearmed_by_game_schedule():
+  from game_modules.blue_archive.action import MARKER_SCHEDULE
+  schedule = MarkerSchedule(MARKER_SCHEDULE)
+  schedule.observe({VideoState.LOADING_SCREEN: True})
+  assert not schedule.relevant('formation-icons')
+  schedule.observe({VideoState.GAMEPLAY_CONCLUDE_SUCCESS: True})
+  assert schedule.relevant('formation-icons')